@@ -17,4 +17,10 @@ if [ -n "$pod_name" ]; then
 fi
 
 echo "master backend state after:"
-echo "show servers state master" | nc localhost 9998
\ No newline at end of file
+echo "show servers state master" | nc localhost 9998
+
+if [ -d /pooler ]; then
+	echo "Notifying the pooler of the master change..."
+	echo "$pod_name,$addr" > /pooler/master.tmp
+	mv /pooler/master.tmp /pooler/master
+fi
\ No newline at end of file
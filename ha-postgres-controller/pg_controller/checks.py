@@ -1,31 +1,230 @@
 import logging
+import math
+import time
+from collections import deque
 
 import psycopg2
 
 from pg_controller import state
-from pg_controller.workers.health_monitor import HealthCheck
+from pg_controller.workers.health_monitor import HealthCheck, Probe
 
 
-class PostgresAliveCheck(HealthCheck):
-    """Performs a simple alive check, by executing a 'SELECT 1' query against the monitored database."""
+def connect(connect_timeout, timeout):
+    """
+    Connects to the monitored database, such that neither connecting nor executing statements on the returned
+    connection would take longer than the given timeout (in seconds).
+    """
+    connect_timeout = max(min(connect_timeout, math.ceil(timeout)), 1)
+    statement_timeout = max(int(timeout * 1000), 1)
+    return psycopg2.connect(user="controller", host="localhost", connect_timeout=connect_timeout,
+                            options="-c statement_timeout=%d" % statement_timeout)
 
-    def __init__(self, failure_threshold, connect_timeout):
-        super().__init__(state.ALIVE_HEALTH_CHECK_NAME, failure_threshold)
+
+class PostgresProbe(Probe):
+    """
+    Collects all the Postgres side signals evaluated by the health checks through a single batched query per snapshot,
+    executed over a single connection that is kept open between snapshots (so that the load on Postgres stays constant
+    regardless of the number of checks). The snapshot contains:
+      * alive: whether the batched query succeeded.
+      * in_recovery, wal_receiver_status, received_lsn, replayed_lsn, replay_lag_seconds and replay_lag_bytes.
+      * seed_subscription: the status of the seed subscription (if tracked), or None if it does not exist.
+      * probe_round_trips_ms: the round trip times of the latency probe queries (if any), or None if they failed.
+      * wal_archive: the WAL archiver statistics along with the archive backlog (if tracked), or None if they could
+        not be queried.
+    The replay throughput is derived from the replayed LSN of consecutive snapshots.
+    """
+
+    SNAPSHOT_QUERY = ("SELECT pg_is_in_recovery(), wal_receiver_status(), pg_last_wal_receive_lsn()::text, "
+                      "pg_last_wal_replay_lsn()::text, extract(epoch FROM now() - pg_last_xact_replay_timestamp()), "
+                      "pg_wal_lsn_diff(pg_last_wal_receive_lsn(), pg_last_wal_replay_lsn())::bigint, {}")
+    SEED_SUBSCRIPTION_QUERY = ("(SELECT json_build_object("
+                               "'lag_seconds', extract(epoch FROM now() - latest_end_time), "
+                               "'lag_bytes', pg_wal_lsn_diff(received_lsn, latest_end_lsn)::bigint, "
+                               "'tables', (SELECT json_object_agg(srrelid::regclass::text, srsubstate) "
+                               "FROM pg_subscription_rel WHERE srsubid = s.subid), "
+                               "'sync_workers', (SELECT count(*) FROM pg_stat_subscription "
+                               "WHERE subid = s.subid AND relid IS NOT NULL)) "
+                               "FROM pg_stat_subscription s WHERE subname = %s AND relid IS NULL)")
+    WAL_ARCHIVE_QUERY = ("SELECT archived_count, failed_count, last_archived_wal, "
+                         "extract(epoch FROM now() - last_archived_time), last_failed_wal, "
+                         "(SELECT count(*) FROM pg_ls_archive_statusdir() WHERE name LIKE '%.ready') "
+                         "FROM pg_stat_archiver")
+
+    def __init__(self, connect_timeout, seed_subscription=None, latency_probe_query=None,
+                 latency_probes=0, wal_archive=False):
+        """
+        :param connect_timeout: The timeout (in seconds) for connecting to Postgres.
+        :param seed_subscription: The name of the seed subscription to track, or None to skip tracking it.
+        :param latency_probe_query: The query whose round trip times are tracked by the latency check, if any.
+        :param latency_probes: The number of latency probe queries to execute per snapshot.
+        :param wal_archive: Whether to track the WAL archiver statistics and the archive backlog.
+        """
         self.connect_timeout = connect_timeout
+        self.seed_subscription = seed_subscription
+        self.latency_probe_query = latency_probe_query
+        self.latency_probes = latency_probes if latency_probe_query else 0
+        self.wal_archive = wal_archive
+        self._conn = None
+        self._last_replay = None
+
+    def _close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def _set_statement_timeout(cursor, deadline):
+        """Sets the statement timeout to the time left till the given deadline."""
+        cursor.execute("SET statement_timeout = %s", (max(int((deadline - time.monotonic()) * 1000), 1),))
+
+    def _execute(self, cursor, deadline, query, params=None):
+        """Executes the given query, such that it is cancelled once the given deadline is reached."""
+        self._set_statement_timeout(cursor, deadline)
+        cursor.execute(query, params)
+
+    def _collect_snapshot(self, deadline):
+        cursor = self._conn.cursor()
+        if self.seed_subscription is None:
+            self._execute(cursor, deadline, self.SNAPSHOT_QUERY.format("NULL"))
+        else:
+            self._execute(cursor, deadline, self.SNAPSHOT_QUERY.format(self.SEED_SUBSCRIPTION_QUERY),
+                          (self.seed_subscription,))
+
+        row = cursor.fetchone()
+        snapshot = {
+            "alive": True,
+            "in_recovery": row[0],
+            "wal_receiver_status": row[1],
+            "received_lsn": row[2],
+            "replayed_lsn": row[3],
+            "replay_lag_seconds": float(row[4]) if row[4] is not None else None,
+            "replay_lag_bytes": row[5],
+            "seed_subscription": row[6],
+            "probe_round_trips_ms": []
+        }
 
-    def do_health_check_impl(self):
-        conn = None
         try:
-            conn = psycopg2.connect(user="controller", host="localhost", connect_timeout=self.connect_timeout)
-            conn.cursor().execute("SELECT 1")
-            logging.info("Postgres is alive!")
-            return True
+            for _ in range(self.latency_probes):
+                if time.monotonic() >= deadline:
+                    logging.warning("Skipping the rest of the latency probes, as the deadline was reached!")
+                    break
+
+                self._set_statement_timeout(cursor, deadline)
+                start = time.monotonic()
+                cursor.execute(self.latency_probe_query)
+                cursor.fetchall()
+                snapshot["probe_round_trips_ms"].append((time.monotonic() - start) * 1000)
         except psycopg2.Error:
-            logging.exception("Postgres is not alive!")
+            logging.exception("Postgres latency probe failed!")
+            snapshot["probe_round_trips_ms"] = None
+
+        if self.latency_probes and not snapshot["probe_round_trips_ms"]:
+            snapshot["probe_round_trips_ms"] = None
+
+        if self.wal_archive:
+            snapshot["wal_archive"] = self._collect_wal_archive(cursor, deadline)
+
+        return snapshot
+
+    def _collect_wal_archive(self, cursor, deadline):
+        if time.monotonic() >= deadline:
+            logging.warning("Skipping the WAL archiver statistics, as the deadline was reached!")
+            return None
+
+        try:
+            self._execute(cursor, deadline, self.WAL_ARCHIVE_QUERY)
+            row = cursor.fetchone()
+        except psycopg2.Error:
+            logging.exception("Could not query the WAL archiver statistics!")
+            return None
+
+        return {
+            "archived_count": row[0],
+            "failed_count": row[1],
+            "last_archived_wal": row[2],
+            "last_archived_seconds_ago": float(row[3]) if row[3] is not None else None,
+            "last_failed_wal": row[4],
+            "backlog_segments": row[5]
+        }
+
+    def collect(self, timeout):
+        """
+        Collects a snapshot over the open connection, where each statement is cancelled once the given timeout is
+        exceeded (the latency probes and the WAL archiver statistics are skipped once it is exceeded). In case there is
+        no open connection, or the open one is broken (e.g. Postgres was restarted), a new connection is opened once,
+        unless a statement timed out. If Postgres can not be queried, a snapshot with 'alive' set to False is returned.
+        """
+        deadline = time.monotonic() + timeout
+        if self._conn is not None:
+            try:
+                return self._report(self._collect_snapshot(deadline))
+            except psycopg2.extensions.QueryCanceledError:
+                logging.exception("Postgres did not respond within %.3fs!", timeout)
+                return self._report({"alive": False})
+            except psycopg2.Error:
+                logging.exception("Could not query Postgres over the open connection, reconnecting...")
+                self._close()
+
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            logging.error("Could not query Postgres, as the deadline was reached!")
+            return self._report({"alive": False})
+
+        try:
+            self._conn = connect(min(self.connect_timeout, remaining_seconds), remaining_seconds)
+            self._conn.autocommit = True
+            return self._report(self._collect_snapshot(deadline))
+        except psycopg2.Error:
+            logging.exception("Could not query Postgres!")
+            self._close()
+            return self._report({"alive": False})
+
+    def _replay_bytes_per_second(self, replayed_lsn):
+        if replayed_lsn is None:
+            self._last_replay = None
+            return None
+
+        high, low = replayed_lsn.split("/")
+        replay = ((int(high, 16) << 32) + int(low, 16), time.monotonic())
+        last_replay, self._last_replay = self._last_replay, replay
+        if last_replay is None or replay[1] <= last_replay[1]:
+            return None
+
+        return max(replay[0] - last_replay[0], 0) / (replay[1] - last_replay[1])
+
+    def _report(self, snapshot):
+        snapshot["replay_bytes_per_second"] = self._replay_bytes_per_second(snapshot.get("replayed_lsn"))
+        state.INSTANCE.set_details("probe", {key: value for key, value in snapshot.items()
+                                             if key not in ("seed_subscription", "probe_round_trips_ms",
+                                                            "wal_archive")})
+        if self.wal_archive:
+            state.INSTANCE.set_details("wal_archive", {
+                "archiver": snapshot.get("wal_archive"),
+                "restoring_from_archive": snapshot.get("in_recovery") is True and
+                                          snapshot.get("wal_receiver_status") != "streaming",
+                "replay_bytes_per_second": snapshot["replay_bytes_per_second"]
+            })
+
+        return snapshot
+
+
+def _is_alive(snapshot):
+    return snapshot is not None and snapshot["alive"] is True
+
+
+class PostgresAliveCheck(HealthCheck):
+    """Performs a simple alive check, by checking whether the probe could query the monitored database."""
+
+    def __init__(self, failure_threshold):
+        super().__init__(state.ALIVE_HEALTH_CHECK_NAME, failure_threshold)
+
+    def do_health_check_impl(self, snapshot):
+        if not _is_alive(snapshot):
+            logging.error("Postgres is not alive!")
             return False
-        finally:
-            if conn:
-                conn.close()
+
+        logging.info("Postgres is alive!")
+        return True
 
     def handle_status(self, is_passing):
         """
@@ -44,37 +243,28 @@ class PostgresAliveCheck(HealthCheck):
 
 class PostgresStandbyReplicationCheck(HealthCheck):
     """
-    Performs a standby replication check, by querying the wal receiver status from the pg_stat_wal_receiver table.
-    This check is skipped in case the role is not 'Standby'.
+    Performs a standby replication check, by checking the wal receiver status (from the pg_stat_wal_receiver table)
+    collected by the probe. This check is skipped in case the role is not 'Standby'.
     """
 
-    def __init__(self, failure_threshold, connect_timeout):
+    def __init__(self, failure_threshold):
         super().__init__(state.STANDBY_REPLICATION_HEALTH_CHECK_NAME, failure_threshold)
-        self.connect_timeout = connect_timeout
 
-    def do_health_check_impl(self):
+    def do_health_check_impl(self, snapshot):
         if state.INSTANCE.role != state.ROLE_STANDBY:
             logging.info("Skipping check as the database role is not Standby!")
             return True
 
-        conn = None
-        try:
-            conn = psycopg2.connect(user="controller", host="localhost", connect_timeout=self.connect_timeout)
-            cursor = conn.cursor()
-            cursor.execute("SELECT wal_receiver_status()")
-            wal_receiver_status = cursor.fetchone()[0]
-            if wal_receiver_status != "streaming":
-                logging.error("Postgres is not replicating! (wal receiver status: %s)", wal_receiver_status)
-                return False
-
-            logging.info("Postgres is replicating!")
-            return True
-        except psycopg2.Error:
-            logging.exception("Postgres is not replicating!")
+        if not _is_alive(snapshot):
+            logging.error("Postgres is not replicating! (not alive)")
+            return False
+
+        if snapshot["wal_receiver_status"] != "streaming":
+            logging.error("Postgres is not replicating! (wal receiver status: %s)", snapshot["wal_receiver_status"])
             return False
-        finally:
-            if conn:
-                conn.close()
+
+        logging.info("Postgres is replicating!")
+        return True
 
     def handle_status(self, is_passing):
         """Updates the replication health check status in the controller's state."""
@@ -83,3 +273,120 @@ class PostgresStandbyReplicationCheck(HealthCheck):
     def continue_checking(self):
         """Returns True if the role is not 'DeadMaster'."""
         return state.INSTANCE.role != state.ROLE_DEAD_MASTER
+
+
+class PostgresLatencyCheck(HealthCheck):
+    """
+    Performs a latency check, by keeping track of the round trip times of the probe queries (executed several times per
+    snapshot by the probe) within a rolling window. The check fails once the p95/p99 round trip time exceeds
+    its threshold, and passes again only after both drop below their threshold multiplied by the recovery ratio. The
+    round trip times are tracked regardless of the role, but the check fails only if the role is 'Standby', as a slow
+    master can not be taken out of the lb without a failover.
+    """
+
+    def __init__(self, failure_threshold, window_size, p95_threshold_ms, p99_threshold_ms, recovery_ratio):
+        super().__init__(state.LATENCY_HEALTH_CHECK_NAME, failure_threshold)
+        self.thresholds_ms = {95: p95_threshold_ms, 99: p99_threshold_ms}
+        self.recovery_ratio = recovery_ratio
+        self._round_trips_ms = deque(maxlen=window_size)
+        self._is_slow = False
+
+    def _percentile(self, percent):
+        round_trips_ms = sorted(self._round_trips_ms)
+        return round_trips_ms[math.ceil(percent / 100 * len(round_trips_ms)) - 1]
+
+    def _exceeds_thresholds(self, percentiles, ratio):
+        return any(threshold is not None and percentiles[percent] > threshold * ratio
+                   for percent, threshold in self.thresholds_ms.items())
+
+    def do_health_check_impl(self, snapshot):
+        if not _is_alive(snapshot) or snapshot["probe_round_trips_ms"] is None:
+            logging.error("Postgres latency probe failed!")
+            return False
+
+        self._round_trips_ms.extend(snapshot["probe_round_trips_ms"])
+        percentiles = {percent: self._percentile(percent) for percent in (50, 95, 99)}
+        if self._is_slow:
+            self._is_slow = self._exceeds_thresholds(percentiles, self.recovery_ratio)
+        else:
+            self._is_slow = self._exceeds_thresholds(percentiles, 1)
+
+        logging.info("Postgres latency (ms): p50=%.1f, p95=%.1f, p99=%.1f", percentiles[50], percentiles[95],
+                     percentiles[99])
+        state.INSTANCE.set_details("latency", {
+            "samples": len(self._round_trips_ms),
+            "p50_ms": percentiles[50],
+            "p95_ms": percentiles[95],
+            "p99_ms": percentiles[99],
+            "slow": self._is_slow
+        })
+
+        if self._is_slow and state.INSTANCE.role == state.ROLE_STANDBY:
+            logging.error("Postgres is too slow!")
+            return False
+
+        return True
+
+    def handle_status(self, is_passing):
+        """Updates the latency health check status in the controller's state."""
+        state.INSTANCE.set_health_check(state.LATENCY_HEALTH_CHECK_NAME, is_passing)
+
+    def continue_checking(self):
+        """Returns True if the role is not 'DeadMaster'."""
+        return state.INSTANCE.role != state.ROLE_DEAD_MASTER
+
+
+class PostgresSeedSubscriptionCheck(HealthCheck):
+    """
+    Tracks the progress of the seed subscription, by checking the sync state of each table (from the
+    pg_subscription_rel table), and the apply lag (from the pg_stat_subscription view) collected by the probe. If
+    holding readiness is enabled, this check fails till the initial copy of all tables is done (once done, the check
+    keeps passing, even if more tables get added to the subscription later). The check passes in case the subscription
+    does not exist.
+    """
+
+    SYNC_STATES = {"i": "init", "d": "copying", "s": "synchronized", "r": "ready"}
+
+    def __init__(self, failure_threshold, hold_readiness):
+        super().__init__(state.SEED_SUBSCRIPTION_HEALTH_CHECK_NAME, failure_threshold)
+        self.hold_readiness = hold_readiness
+        self._initial_copy_done = False
+
+    def do_health_check_impl(self, snapshot):
+        if not _is_alive(snapshot):
+            logging.error("Could not query the seed subscription status!")
+            return False
+
+        subscription = snapshot["seed_subscription"]
+        if subscription is None:
+            logging.info("Skipping check as the seed subscription does not exist!")
+            self._initial_copy_done = True
+            return True
+
+        tables = {table: self.SYNC_STATES.get(sync_state, sync_state)
+                  for table, sync_state in (subscription["tables"] or {}).items()}
+        pending_tables = [table for table, sync_state in tables.items() if sync_state not in ("synchronized", "ready")]
+        self._initial_copy_done = self._initial_copy_done or not pending_tables
+        state.INSTANCE.set_details("seed_subscription", {
+            "tables": tables,
+            "pending_tables": len(pending_tables),
+            "sync_workers": subscription["sync_workers"],
+            "initial_copy_done": self._initial_copy_done,
+            "apply_lag_seconds": subscription["lag_seconds"],
+            "apply_lag_bytes": subscription["lag_bytes"]
+        })
+
+        if self.hold_readiness and not self._initial_copy_done:
+            logging.error("Seed subscription initial copy is not done yet! (pending tables: %d)", len(pending_tables))
+            return False
+
+        logging.info("Seed subscription is synced! (pending tables: %d)", len(pending_tables))
+        return True
+
+    def handle_status(self, is_passing):
+        """Updates the seed subscription health check status in the controller's state."""
+        state.INSTANCE.set_health_check(state.SEED_SUBSCRIPTION_HEALTH_CHECK_NAME, is_passing)
+
+    def continue_checking(self):
+        """Returns True if the role is not 'DeadMaster'."""
+        return state.INSTANCE.role != state.ROLE_DEAD_MASTER
@@ -6,20 +6,33 @@ import psycopg2
 import requests
 
 from pg_controller import state
-from pg_controller.checks import PostgresAliveCheck, PostgresStandbyReplicationCheck
+from pg_controller.checks import PostgresProbe, PostgresAliveCheck, PostgresStandbyReplicationCheck, \
+    PostgresLatencyCheck, PostgresSeedSubscriptionCheck
+from pg_controller.replication_slots import ReplicationSlotManager
+from pg_controller.tuning import PostgresTuner, parse_quantity
+from pg_controller.workers.agent_check import AgentCheckServer
+from pg_controller.workers.debug import DebugServer
 from pg_controller.workers.election import Election, ElectionStatusHandler
 from pg_controller.workers.health_monitor import HealthMonitor
 from pg_controller.workers.management import ManagementServer
 
+DEFAULT_REPLICATION_SLOT_MAX_RETAINED_WAL_MB = 256
+REPLICATION_SLOTS_MAX_STORAGE_RATIO = 0.5
+
 
 class PostgresMasterElectionStatusHandler(ElectionStatusHandler):
     """
     Promotes a standby database to master, by executing Postgres's 'pg_promote' sql function against the monitored
-    database.
+    database. It also fences the master database in case it loses the lock over the election key.
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, super_user):
+        """
+        :param super_user: The name of Postgres's super user (used for fencing the master database).
+        """
+        self._super_user = super_user
+        self._fence_lock = threading.Lock()
+        self._fenced = False
 
     def handle_status(self, is_leader):
         """
@@ -52,12 +65,51 @@ class PostgresMasterElectionStatusHandler(ElectionStatusHandler):
         """Returns True if the role is 'Standby'."""
         return state.INSTANCE.role == state.ROLE_STANDBY
 
+    def continue_watching(self):
+        """Returns True if the role is 'Master'."""
+        return state.INSTANCE.role == state.ROLE_MASTER
+
+    def fence(self):
+        """
+        Fences the master database by making new transactions read-only (through 'ALTER SYSTEM' followed by reloading
+        the configuration, which, unlike 'ALTER DATABASE', is not replicated to the standbys), and terminating the
+        client backends. Returns True if the database is fenced (fencing is done only once).
+        """
+        with self._fence_lock:
+            if self._fenced:
+                return True
+
+            logging.info('Fencing the master database!')
+            conn = None
+            try:
+                conn = psycopg2.connect(user=self._super_user, host='localhost', connect_timeout=1)
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute('ALTER SYSTEM SET default_transaction_read_only = on')
+                cursor.execute('SELECT pg_reload_conf()')
+                cursor.execute("SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                               "WHERE backend_type = 'client backend' AND pid <> pg_backend_pid()")
+                self._fenced = True
+            except:
+                logging.exception('An exception occurred during fencing!')
+            finally:
+                if conn:
+                    conn.close()
+
+            return self._fenced
+
+    def handle_leadership_lost(self):
+        """Fences the master database, then sets the role to 'DeadMaster'."""
+        self.fence()
+        state.INSTANCE.role = state.ROLE_DEAD_MASTER
+
 
 class Controller:
 
     def __init__(self):
         self._worker_threads = []
         self._args = self._parse_args()
+        self._postgres_storage_bytes = self._parse_storage_size(self._args.postgres_storage_size)
         state.INSTANCE = state.State(self._args.consul_key_prefix, self._args.host_name)
 
     @staticmethod
@@ -65,8 +117,13 @@ class Controller:
         parser = argparse.ArgumentParser(description='Controller daemon for ha-postgres')
         parser.add_argument('--consul-key-prefix', default='service/postgres',
                             help='The Consul key path prefix to use for the election key or for storing state')
-        parser.add_argument('--check-interval', type=int,
+        parser.add_argument('--check-interval', type=int, default=10,
                             help='The time interval (in seconds) between two consecutive health/leader election checks')
+        parser.add_argument('--check-jitter', type=float, default=0,
+                            help='The maximum random delay (in seconds) added to each scheduled health check')
+        parser.add_argument('--check-timeout', type=float,
+                            help='The time (in seconds) a health check, including updating its Consul check, is given '
+                                 'to finish (defaults to the check interval)')
         parser.add_argument('--connect-timeout', type=int, default=1,
                             help='The timeout (in seconds) for connecting to Postgres during health checks')
         parser.add_argument('--alive-check-failure-threshold', type=int, default=1,
@@ -74,29 +131,182 @@ class Controller:
         parser.add_argument('--standby-replication-check-failure-threshold', type=int, default=4,
                             help='The number of consecutive failures for the standby replication health check '
                                  'to be considered failed')
+        parser.add_argument('--latency-check-p95-threshold', type=float,
+                            help='The p95 probe round trip time (in milliseconds) for the latency health check to be '
+                                 'considered failed (the check is enabled only if a p95/p99 threshold is set)')
+        parser.add_argument('--latency-check-p99-threshold', type=float,
+                            help='The p99 probe round trip time (in milliseconds) for the latency health check to be '
+                                 'considered failed (the check is enabled only if a p95/p99 threshold is set)')
+        parser.add_argument('--latency-check-query', default='SELECT 1',
+                            help='The representative query used by the latency health check to probe Postgres')
+        parser.add_argument('--latency-check-probes', type=int, default=5,
+                            help='The number of probe queries executed during each latency health check')
+        parser.add_argument('--latency-check-window', type=int, default=60,
+                            help='The number of most recent probe round trip times to calculate the percentiles from')
+        parser.add_argument('--latency-check-recovery-ratio', type=float, default=0.8,
+                            help='The ratio of the thresholds that the percentiles need to drop below for a failed '
+                                 'latency health check to pass again')
+        parser.add_argument('--latency-check-failure-threshold', type=int, default=1,
+                            help='The number of consecutive failures for the latency health check to be considered '
+                                 'failed')
+        parser.add_argument('--seed-subscription',
+                            help='The name of the seed subscription whose progress is to be tracked (tracking is '
+                                 'enabled only if set)')
+        parser.add_argument('--hold-readiness-till-seeded', action='store_true',
+                            help='Consider the database not ready till the initial copy of the seed subscription is '
+                                 'done')
+        parser.add_argument('--wal-archive', action='store_true',
+                            help='Track the WAL archiver statistics, the archive backlog and the replay throughput')
+        parser.add_argument('--manage-replication-slots', action='store_true',
+                            help='Maintain a physical replication slot on the master for each registered standby')
+        parser.add_argument('--replication-slot-grace-period', type=int, default=300,
+                            help='The time (in seconds) a standby may stay unregistered from Consul before its '
+                                 'replication slot is dropped')
+        parser.add_argument('--replication-slot-max-retained-wal', type=int,
+                            help='The maximum WAL size (in MB) an inactive replication slot may retain before it is '
+                                 'dropped (half of the storage size divided by the number of standbys if not set)')
+        parser.add_argument('--cluster-size', type=int, default=1,
+                            help='The number of database instances, i.e. the master and its standbys (used for '
+                                 'deriving the maximum WAL size retained by replication slots)')
+        parser.add_argument('--tune-postgres', action='store_true',
+                            help='Tune Postgres settings according to its resources and role (at startup, and once '
+                                 'promoted to master)')
+        parser.add_argument('--super-user', default='postgres',
+                            help='The name of Postgres\'s super user (used for tuning Postgres settings, and fencing '
+                                 'the master)')
+        parser.add_argument('--postgres-cpu-limit', type=int,
+                            help='The cpu limit (in millicores) of Postgres (read from the cgroup if not set)')
+        parser.add_argument('--postgres-memory-limit', type=int,
+                            help='The memory limit (in bytes) of Postgres (read from the cgroup if not set)')
+        parser.add_argument('--postgres-storage-size',
+                            help='The storage size of Postgres as a K8s quantity, e.g. 1.5Gi (WAL settings are not '
+                                 'tuned, and the maximum WAL size retained by replication slots is not derived if '
+                                 'not set)')
+        parser.add_argument('--tuning-exclude', default='',
+                            help='A comma separated list of Postgres settings to leave untouched while tuning')
+        parser.add_argument('--session-lock-delay',
+                            help='The lock delay of the election Consul session, e.g. 15s (Consul\'s default if not '
+                                 'set)')
+        parser.add_argument('--session-behavior', choices=['release', 'delete'],
+                            help='The invalidation behavior of the election Consul session (Consul\'s default if not '
+                                 'set)')
+        parser.add_argument('--session-ttl',
+                            help='The TTL of the election Consul session, e.g. 30s, which should be larger than the '
+                                 'check interval (no TTL if not set)')
         parser.add_argument('--management-port', type=int, default=80,
                             help='The port on which the controller exposes the management API')
+        parser.add_argument('--agent-check-port', type=int,
+                            help='The port on which the controller responds to HAProxy agent checks (the agent check '
+                                 'server is enabled only if set)')
+        parser.add_argument('--debug-port', type=int,
+                            help='The port (on the loopback interface) on which the controller exposes the debug API '
+                                 '(the debug API and the SIGUSR1 stack dump handler are enabled only if set)')
         parser.add_argument('--host-name', help='The name of this host')
         parser.add_argument('--host-ip', help='The ip of this host')
         return parser.parse_args()
 
-    def _start_alive_health_monitor(self):
-        """Starts a monitoring worker thread with the alive health check."""
-        health_check = PostgresAliveCheck(self._args.alive_check_failure_threshold, self._args.connect_timeout)
-        health_monitor = HealthMonitor(health_check, self._args.check_interval)
-        health_monitor.setName("AliveMonitor")
-        health_monitor.start()
-        self._worker_threads.append(health_monitor)
+    @staticmethod
+    def _parse_storage_size(storage_size):
+        """Returns the given storage size (a K8s quantity) in bytes, or None if it is not set or invalid."""
+        if not storage_size:
+            return None
 
-    def _start_standby_replication_health_monitor(self):
-        """Starts a monitoring worker thread with the standby replication health check."""
-        health_check = PostgresStandbyReplicationCheck(self._args.standby_replication_check_failure_threshold,
-                                                       self._args.connect_timeout)
-        health_monitor = HealthMonitor(health_check, self._args.check_interval)
-        health_monitor.setName("ReplicationMonitor")
+        try:
+            return parse_quantity(storage_size)
+        except ValueError:
+            logging.warning("Ignoring the invalid storage size: %s!", storage_size)
+            return None
+
+    def _start_health_monitor(self):
+        """
+        Starts a monitoring worker thread with the alive and standby replication health checks, along with the latency
+        health check (if any of its thresholds is set) and the seed subscription health check (if the subscription is
+        set), all of which evaluate the snapshots collected by a single probe.
+        """
+        health_checks = [PostgresAliveCheck(self._args.alive_check_failure_threshold),
+                         PostgresStandbyReplicationCheck(self._args.standby_replication_check_failure_threshold)]
+
+        latency_probe_query = None
+        if self._args.latency_check_p95_threshold is not None or self._args.latency_check_p99_threshold is not None:
+            latency_probe_query = self._args.latency_check_query
+            health_checks.append(PostgresLatencyCheck(self._args.latency_check_failure_threshold,
+                                                      self._args.latency_check_window,
+                                                      self._args.latency_check_p95_threshold,
+                                                      self._args.latency_check_p99_threshold,
+                                                      self._args.latency_check_recovery_ratio))
+            state.INSTANCE.add_health_check(state.LATENCY_HEALTH_CHECK_NAME)
+
+        if self._args.seed_subscription is not None:
+            health_checks.append(PostgresSeedSubscriptionCheck(1, self._args.hold_readiness_till_seeded))
+            state.INSTANCE.add_health_check(state.SEED_SUBSCRIPTION_HEALTH_CHECK_NAME)
+
+        probe = PostgresProbe(self._args.connect_timeout, self._args.seed_subscription, latency_probe_query,
+                              self._args.latency_check_probes, self._args.wal_archive)
+        health_monitor = HealthMonitor(probe, health_checks, self._args.check_interval, self._args.check_jitter,
+                                       self._args.check_timeout)
         health_monitor.start()
         self._worker_threads.append(health_monitor)
 
+    def _tune_postgres(self):
+        """
+        Tunes Postgres settings according to its resources and role, if tuning is enabled. Postgres is re-tuned once
+        promoted to master, so that it does not keep running with the settings computed for a standby.
+        """
+        if not self._args.tune_postgres:
+            return
+
+        cpu_limit = self._args.postgres_cpu_limit / 1000 if self._args.postgres_cpu_limit else None
+        tuner = PostgresTuner(self._args.super_user, cpu_limit, self._args.postgres_memory_limit,
+                              self._postgres_storage_bytes, filter(None, self._args.tuning_exclude.split(',')))
+        self._apply_tuning(tuner, state.INSTANCE.role)
+        state.INSTANCE.add_role_listener(lambda role: self._retune_postgres(tuner, role))
+
+    @staticmethod
+    def _apply_tuning(tuner, role):
+        """Tunes Postgres settings for the given role."""
+        try:
+            tuner.tune(role)
+        except:
+            logging.exception("An exception was encountered during tuning Postgres!")
+
+    def _retune_postgres(self, tuner, role):
+        """
+        Re-tunes Postgres settings in a separate thread as soon as the role is set to 'Master', so that the promotion
+        is not delayed.
+        """
+        if role == state.ROLE_MASTER:
+            threading.Thread(target=self._apply_tuning, args=(tuner, role), name="Tuner", daemon=True).start()
+
+    def _start_replication_slot_manager(self):
+        """Starts the replication slot manager worker thread, if managing replication slots is enabled."""
+        if not self._args.manage_replication_slots:
+            return
+
+        replication_slot_manager = ReplicationSlotManager(self._args.consul_key_prefix, self._args.host_name,
+                                                          self._args.connect_timeout,
+                                                          self._args.check_interval,
+                                                          self._args.replication_slot_grace_period,
+                                                          self._replication_slot_max_retained_wal_bytes())
+        replication_slot_manager.start()
+        self._worker_threads.append(replication_slot_manager)
+
+    def _replication_slot_max_retained_wal_bytes(self):
+        """
+        Returns the maximum WAL size (in bytes) an inactive replication slot may retain. Unless set explicitly, it is
+        derived from the storage size, so that the slots of all the standbys together could not retain more than half
+        of the storage.
+        """
+        if self._args.replication_slot_max_retained_wal is not None:
+            return self._args.replication_slot_max_retained_wal * 1024 * 1024
+
+        storage_size = self._postgres_storage_bytes
+        if not storage_size:
+            logging.warning("The storage size is not set (or invalid), using the default maximum WAL size of %d MB "
+                            "retained by replication slots!", DEFAULT_REPLICATION_SLOT_MAX_RETAINED_WAL_MB)
+            return DEFAULT_REPLICATION_SLOT_MAX_RETAINED_WAL_MB * 1024 * 1024
+
+        return int(storage_size * REPLICATION_SLOTS_MAX_STORAGE_RATIO / max(self._args.cluster_size - 1, 1))
+
     @staticmethod
     def _register_consul_service():
         """Registers the 'postgres' service in Consul."""
@@ -107,22 +317,62 @@ class Controller:
 
     def _start_election(self,):
         """Starts the election worker thread."""
+        election_status_handler = PostgresMasterElectionStatusHandler(self._args.super_user)
         election = Election(election_consul_key=self._args.consul_key_prefix + "/master",
                             consul_session_checks=[state.ALIVE_HEALTH_CHECK_NAME,
                                                    state.STANDBY_REPLICATION_HEALTH_CHECK_NAME],
-                            election_status_handler=PostgresMasterElectionStatusHandler(),
+                            election_status_handler=election_status_handler,
                             host_name=self._args.host_name,
                             host_ip=self._args.host_ip,
-                            check_interval_seconds=self._args.check_interval)
+                            check_interval_seconds=self._args.check_interval,
+                            session_lock_delay=self._args.session_lock_delay,
+                            session_behavior=self._args.session_behavior,
+                            session_ttl=self._args.session_ttl)
+        state.INSTANCE.add_role_listener(
+            lambda role: self._release_election_lock(election, election_status_handler, role))
         election.start()
         self._worker_threads.append(election)
 
+    @staticmethod
+    def _release_election_lock(election, election_status_handler, role):
+        """
+        Fences the master database, then releases the election lock, as soon as the role is set to 'DeadMaster'. In
+        case fencing fails (e.g. Postgres is too overloaded to accept connections, while still serving the open ones),
+        the lock is not released explicitly, but left for Consul to invalidate the session (due to the failing alive
+        check), so that the session's lock delay still applies before a standby could take over.
+        """
+        if role != state.ROLE_DEAD_MASTER:
+            return
+
+        if election_status_handler.fence():
+            election.release_lock()
+        else:
+            logging.warning("Not releasing the election lock, as the master database could not be fenced!")
+
     def _start_management_server(self):
         """Starts the management server worker thread."""
-        management_server = ManagementServer(self._args.management_port)
+        management_server = ManagementServer(self._args.management_port, self._worker_threads)
         management_server.start()
         self._worker_threads.append(management_server)
 
+    def _start_agent_check_server(self):
+        """Starts the agent check server worker thread, if the agent check port is set."""
+        if self._args.agent_check_port is None:
+            return
+
+        agent_check_server = AgentCheckServer(self._args.agent_check_port)
+        agent_check_server.start()
+        self._worker_threads.append(agent_check_server)
+
+    def _start_debug_server(self):
+        """Starts the debug server worker thread, if the debug port is set."""
+        if self._args.debug_port is None:
+            return
+
+        debug_server = DebugServer(self._args.debug_port)
+        debug_server.start()
+        self._worker_threads.append(debug_server)
+
     def stop(self, *args):
         """Stops all worker threads, and waits for them to finish."""
         for worker_thread in self._worker_threads:
@@ -135,11 +385,14 @@ class Controller:
         threading.current_thread().name = "Controller"
         try:
             self._start_management_server()
-            self._start_alive_health_monitor()
-            self._start_standby_replication_health_monitor()
+            self._start_agent_check_server()
+            self._start_debug_server()
+            self._start_health_monitor()
             self._register_consul_service()
             state.INSTANCE.wait_till_healthy()
+            self._tune_postgres()
             self._start_election()
+            self._start_replication_slot_manager()
             state.INSTANCE.done_initializing()
         except:
             logging.exception("An exception was encountered during startup!")
@@ -0,0 +1,130 @@
+import logging
+import re
+import time
+
+import requests
+
+from pg_controller import state
+from pg_controller.checks import connect
+from pg_controller.workers.looping_thread import LoopingThread
+
+
+SLOT_NAME_PREFIX = "ha_standby_"
+
+
+def slot_name(node):
+    """
+    Returns the name of the physical replication slot used by the standby running on the given node (truncated to
+    Postgres's maximum identifier length). The names share a fixed prefix, so that slots not created by the
+    controller (e.g. for pg_receivewal or backups) are left untouched.
+    """
+    return (SLOT_NAME_PREFIX + re.sub("[^a-z0-9_]", "_", node.lower()))[:63]
+
+
+class ReplicationSlotManager(LoopingThread):
+    """
+    Maintains a physical replication slot on the master database for each standby registered in the 'postgres' Consul
+    service (except for the ones whose role is 'DeadMaster'). Slots of standbys that are no longer registered for longer
+    than a grace period are dropped, and so are inactive slots that retain more WAL than allowed (to protect the
+    master's disk). Only the slots named by slot_name are managed. This thread does nothing while the role is
+    'Standby', so that the slots get recreated on the new master after a failover.
+    """
+
+    CONSUL_SERVICE_URL = state.CONSUL_BASE_URL + "/catalog/service/postgres"
+
+    def __init__(self, consul_key_prefix, host_name, connect_timeout, check_interval_seconds, grace_period_seconds,
+                 max_retained_wal_bytes):
+        """
+        :param consul_key_prefix: The Consul key path prefix under which the role of each host is stored.
+        :param host_name: The name of this host, which is excluded from the standbys.
+        :param connect_timeout: The timeout (in seconds) for connecting to Postgres.
+        :param check_interval_seconds: The time interval (in seconds) between two consecutive slot reconciliations.
+        :param grace_period_seconds: The time (in seconds) a standby may stay unregistered before dropping its slot.
+        :param max_retained_wal_bytes: The maximum WAL size (in bytes) an inactive slot may retain before dropping it.
+        """
+        super().__init__(check_interval_seconds)
+        self._consul_key_prefix = consul_key_prefix
+        self._host_name = host_name
+        self._connect_timeout = connect_timeout
+        self._grace_period_seconds = grace_period_seconds
+        self._max_retained_wal_bytes = max_retained_wal_bytes
+        self._last_seen = {}
+
+    def _is_dead_master(self, node):
+        response = requests.get(state.State.CONSUL_KV_URL.format("%s/%s/role" % (self._consul_key_prefix, node)),
+                                timeout=max(self.remaining_seconds(), 0.1))
+        if response.status_code == 404:
+            return False
+
+        response.raise_for_status()
+        return response.text == state.ROLE_DEAD_MASTER
+
+    def _query_standby_slots(self):
+        response = requests.get(self.CONSUL_SERVICE_URL, timeout=max(self.remaining_seconds(), 0.1))
+        response.raise_for_status()
+        return {slot_name(entry["Node"]) for entry in response.json()
+                if entry["Node"] != self._host_name and not self._is_dead_master(entry["Node"])}
+
+    def _should_drop(self, slot, is_active, retained_wal_bytes, standby_slots):
+        if is_active:
+            return False
+
+        if slot not in standby_slots and time.monotonic() - self._last_seen[slot] > self._grace_period_seconds:
+            logging.info("Standby of slot %s is gone for more than %ds", slot, self._grace_period_seconds)
+            return True
+
+        if retained_wal_bytes is not None and retained_wal_bytes > self._max_retained_wal_bytes:
+            logging.warning("Inactive slot %s retains %d bytes of WAL, exceeding the maximum of %d bytes!", slot,
+                            retained_wal_bytes, self._max_retained_wal_bytes)
+            return True
+
+        return False
+
+    def _reconcile_slots(self, standby_slots):
+        conn = None
+        try:
+            conn = connect(self._connect_timeout, self.remaining_seconds())
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute("SELECT slot_name, active, pg_wal_lsn_diff(pg_current_wal_lsn(), restart_lsn)::bigint "
+                           "FROM pg_replication_slots WHERE slot_type = 'physical'")
+            existing_slots = {row[0]: row[1:] for row in cursor.fetchall() if row[0].startswith(SLOT_NAME_PREFIX)}
+
+            now = time.monotonic()
+            for slot in standby_slots | set(existing_slots):
+                if slot in standby_slots or slot not in self._last_seen:
+                    self._last_seen[slot] = now
+
+            for slot in standby_slots - set(existing_slots):
+                logging.info("Creating replication slot %s", slot)
+                cursor.execute("SELECT pg_create_physical_replication_slot(%s, true)", (slot,))
+                existing_slots[slot] = (False, None)
+
+            for slot, (is_active, retained_wal_bytes) in list(existing_slots.items()):
+                if self._should_drop(slot, is_active, retained_wal_bytes, standby_slots):
+                    logging.info("Dropping replication slot %s", slot)
+                    cursor.execute("SELECT pg_drop_replication_slot(%s)", (slot,))
+                    existing_slots[slot] = None
+
+            state.INSTANCE.set_details("replication_slots", {
+                slot: {"active": slot_info[0], "retained_wal_bytes": slot_info[1]}
+                for slot, slot_info in existing_slots.items() if slot_info is not None
+            })
+        finally:
+            if conn:
+                conn.close()
+
+    def do_one_run(self):
+        """
+        Creates the missing replication slots for the registered standbys, and drops the ones that should not be kept
+        anymore, in case the role is 'Master'. Finally, it stops in case the role is 'DeadMaster'.
+        """
+        if state.INSTANCE.role == state.ROLE_MASTER:
+            try:
+                self._reconcile_slots(self._query_standby_slots())
+            except:
+                logging.exception("An error occurred during managing replication slots!")
+
+        if state.INSTANCE.role == state.ROLE_DEAD_MASTER:
+            logging.info("Stopping as the database role is DeadMaster!")
+            self.stop()
@@ -1,7 +1,6 @@
 import logging
 import threading
 import time
-from functools import reduce
 
 import requests
 
@@ -10,13 +9,15 @@ ROLE_STANDBY = "Standby"
 ROLE_DEAD_MASTER = "DeadMaster"
 ALIVE_HEALTH_CHECK_NAME = "postgresAlive"
 STANDBY_REPLICATION_HEALTH_CHECK_NAME = "postgresStandbyReplication"
+LATENCY_HEALTH_CHECK_NAME = "postgresLatency"
+SEED_SUBSCRIPTION_HEALTH_CHECK_NAME = "postgresSeedSubscription"
 CONSUL_BASE_URL = "http://localhost:8500/v1"
 
 
 class State:
     """
     Holds the state of the controller, mainly the role of the monitored database along with the status of the health
-    checks.
+    checks. It also holds details reported by the controller's workers (e.g. the latency statistics).
     """
 
     CONSUL_KV_URL = CONSUL_BASE_URL + "/kv/{}?raw"
@@ -25,11 +26,13 @@ class State:
         self._election_consul_key = consul_key_prefix + "/master"
         self._role_consul_key = "%s/%s/role" % (consul_key_prefix, host_name)
         self._role = None
+        self._role_listeners = []
         self._set_initial_role()
         self._health_checks = {
             ALIVE_HEALTH_CHECK_NAME: threading.Event(),
             STANDBY_REPLICATION_HEALTH_CHECK_NAME: threading.Event()
         }
+        self._details = {}
         self._initialized = False
 
     @property
@@ -39,12 +42,28 @@ class State:
 
     @role.setter
     def role(self, role):
-        """Sets the role of the database."""
+        """Sets the role of the database, and notifies the role listeners."""
         self._role = role
+        for listener in self._role_listeners:
+            try:
+                listener(role)
+            except:
+                logging.exception("An error occurred during notifying a role listener!")
 
         logging.info("Setting Consul key: %s, to value: %s", self._role_consul_key, role)
         self._set_consul_key(self._role_consul_key, role)
 
+    def add_role_listener(self, listener):
+        """Adds a listener (a callable) to be called with the new role whenever the role is set."""
+        self._role_listeners.append(listener)
+
+    def add_health_check(self, name):
+        """
+        Adds a health check with the given name, which needs to pass as well for the database to be ready (it is not
+        waited for by wait_till_healthy though).
+        """
+        self._health_checks[name] = threading.Event()
+
     def set_health_check(self, name, is_passing):
         """Sets the status of the health check with the given name."""
         if is_passing is True:
@@ -52,10 +71,23 @@ class State:
         else:
             self._health_checks[name].clear()
 
+    def is_health_check_passing(self, name):
+        """Returns whether the health check with the given name is passing or not."""
+        return self._health_checks[name].is_set()
+
     def wait_till_healthy(self):
-        """Blocks until each health check is set to passing."""
-        for check in self._health_checks.values():
-            check.wait()
+        """Blocks until the alive and the standby replication health checks are set to passing."""
+        for name in (ALIVE_HEALTH_CHECK_NAME, STANDBY_REPLICATION_HEALTH_CHECK_NAME):
+            self._health_checks[name].wait()
+
+    @property
+    def details(self):
+        """Returns the details reported by the controller's workers."""
+        return dict(self._details)
+
+    def set_details(self, name, details):
+        """Sets the details reported under the given name."""
+        self._details[name] = details
 
     @property
     def initialized(self):
@@ -76,7 +108,7 @@ class State:
         if self._role == ROLE_DEAD_MASTER:
             return False
 
-        is_healthy = reduce(lambda x, y: x.is_set() and y.is_set(), self._health_checks.values())
+        is_healthy = all(check.is_set() for check in self._health_checks.values())
         return self._initialized and is_healthy
 
     def _set_initial_role(self):
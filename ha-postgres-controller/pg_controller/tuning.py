@@ -0,0 +1,178 @@
+import logging
+import math
+import os
+import re
+from decimal import Decimal
+
+import psycopg2
+from psycopg2 import sql
+
+from pg_controller import state
+
+MB = 1024 * 1024
+QUANTITY_SUFFIXES = {"": 1, "m": Decimal("0.001"), "k": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4,
+                     "P": 1000 ** 5, "E": 1000 ** 6, "Ki": 1024, "Mi": 1024 ** 2, "Gi": 1024 ** 3, "Ti": 1024 ** 4,
+                     "Pi": 1024 ** 5, "Ei": 1024 ** 6}
+QUANTITY_PATTERN = re.compile(r"([+-]?(?:\d+\.?\d*|\.\d+))(?:[eE]([+-]?\d+)|(Ki|Mi|Gi|Ti|Pi|Ei|m|k|M|G|T|P|E)?)")
+
+
+def parse_quantity(quantity):
+    """
+    Parses a K8s quantity (e.g. '1Gi', '1.5G', '100k' or '1e9'), and returns its value in bytes (rounded up, as K8s
+    does).
+    """
+    match = QUANTITY_PATTERN.fullmatch(quantity.strip())
+    if not match:
+        raise ValueError("Invalid quantity: %s" % quantity)
+
+    number, exponent, suffix = match.groups()
+    multiplier = Decimal(10) ** int(exponent) if exponent is not None else QUANTITY_SUFFIXES[suffix or ""]
+    return math.ceil(Decimal(number) * multiplier)
+
+
+def read_cgroup_limits():
+    """
+    Returns the cpu limit (in cores) and the memory limit (in bytes) of the container's cgroup (either v2 or v1),
+    where any of them is None if not limited.
+    """
+    cpus, memory_bytes = None, None
+    if os.path.exists("/sys/fs/cgroup/cpu.max"):
+        quota, period = _read_file("/sys/fs/cgroup/cpu.max").split()
+        if quota != "max":
+            cpus = int(quota) / int(period)
+
+        memory_max = _read_file("/sys/fs/cgroup/memory.max")
+        if memory_max != "max":
+            memory_bytes = int(memory_max)
+    elif os.path.exists("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"):
+        quota = int(_read_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"))
+        if quota > 0:
+            cpus = quota / int(_read_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us"))
+
+        memory_limit = int(_read_file("/sys/fs/cgroup/memory/memory.limit_in_bytes"))
+        if memory_limit < os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"):
+            memory_bytes = memory_limit
+
+    return cpus, memory_bytes
+
+
+def _read_file(path):
+    with open(path) as file:
+        return file.read().strip()
+
+
+def _format_mb(megabytes):
+    """Formats the given size the same way Postgres shows memory settings."""
+    megabytes = max(int(megabytes), 1)
+    if megabytes % 1024 == 0:
+        return "%dGB" % (megabytes // 1024)
+
+    return "%dMB" % megabytes
+
+
+def compute_settings(cpus, memory_bytes, storage_bytes, max_connections, role):
+    """
+    Computes the Postgres settings that fit the given resources and database role. Settings that need to be the same
+    on the master and the standbys (e.g. max_worker_processes) are left untouched.
+    """
+    settings = {}
+    if memory_bytes:
+        memory_mb = memory_bytes // MB
+        shared_buffers_mb = memory_mb // 4
+        settings["shared_buffers"] = _format_mb(shared_buffers_mb)
+        settings["effective_cache_size"] = _format_mb(memory_mb * 3 // 4)
+        settings["maintenance_work_mem"] = _format_mb(min(max(memory_mb // 16, 16), 2048))
+        settings["work_mem"] = _format_mb(max((memory_mb - shared_buffers_mb) // (max_connections * 3), 4))
+        if role == state.ROLE_MASTER:
+            settings["wal_buffers"] = _format_mb(min(max(shared_buffers_mb // 32, 1), 16))
+
+    if cpus:
+        cores = max(math.floor(cpus), 1)
+        settings["max_parallel_workers"] = str(cores)
+        settings["max_parallel_maintenance_workers"] = str(cores // 2)
+        if role == state.ROLE_MASTER:
+            settings["max_parallel_workers_per_gather"] = str(cores // 4)
+        else:
+            settings["max_parallel_workers_per_gather"] = str(cores // 2)
+
+    if storage_bytes:
+        max_wal_size_mb = min(max(storage_bytes // MB // 4, 64), 16384)
+        settings["max_wal_size"] = _format_mb(max_wal_size_mb)
+        settings["min_wal_size"] = _format_mb(max(max_wal_size_mb // 4, 32))
+        settings["checkpoint_completion_target"] = "0.9"
+
+    return settings
+
+
+class PostgresTuner:
+    """
+    Tunes the monitored database's settings according to the resources given to it, by executing 'ALTER SYSTEM' (as
+    the super user) followed by reloading the configuration. Changes to settings that require a restart are reported
+    as pending.
+    """
+
+    def __init__(self, super_user, cpu_limit, memory_limit, storage_size, excluded_settings):
+        """
+        :param super_user: The name of Postgres's super user.
+        :param cpu_limit: The cpu limit (in cores) of the database, read from the cgroup if not set.
+        :param memory_limit: The memory limit (in bytes) of the database, read from the cgroup if not set.
+        :param storage_size: The storage size (in bytes) of the database, or None if unknown.
+        :param excluded_settings: The names of the settings to leave untouched (e.g. the ones set explicitly).
+        """
+        cgroup_cpus, cgroup_memory_bytes = None, None
+        if cpu_limit is None or memory_limit is None:
+            try:
+                cgroup_cpus, cgroup_memory_bytes = read_cgroup_limits()
+            except (OSError, ValueError):
+                logging.exception("Could not read the cgroup limits!")
+
+        self._super_user = super_user
+        self._cpus = cpu_limit or cgroup_cpus
+        self._memory_bytes = memory_limit or cgroup_memory_bytes
+        self._storage_bytes = storage_size
+        self._excluded_settings = set(excluded_settings)
+
+    def tune(self, role):
+        """Applies the settings computed for the given role, and reports the changed ones."""
+        logging.info("Tuning Postgres for role %s (cpus: %s, memory: %s bytes, storage: %s bytes)", role,
+                     self._cpus, self._memory_bytes, self._storage_bytes)
+        conn = None
+        try:
+            conn = psycopg2.connect(user=self._super_user, host="localhost", connect_timeout=5)
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute("SELECT current_setting('max_connections')::int")
+            settings = compute_settings(self._cpus, self._memory_bytes, self._storage_bytes, cursor.fetchone()[0],
+                                        role)
+
+            changed_settings = {}
+            for name, value in settings.items():
+                if name in self._excluded_settings:
+                    continue
+
+                cursor.execute("SELECT current_setting(%s)", (name,))
+                current_value = cursor.fetchone()[0]
+                if current_value != value:
+                    logging.info("Setting %s to %s (was %s)", name, value, current_value)
+                    cursor.execute(sql.SQL("ALTER SYSTEM SET {} = {}").format(sql.Identifier(name),
+                                                                              sql.Literal(value)))
+                    changed_settings[name] = {"from": current_value, "to": value}
+
+            cursor.execute("SELECT pg_reload_conf()")
+            cursor.execute("SELECT name FROM pg_settings WHERE pending_restart OR (context = 'postmaster' AND "
+                           "name = ANY(%s))", (list(changed_settings),))
+            pending_restart = [row[0] for row in cursor.fetchall()]
+            if pending_restart:
+                logging.warning("Postgres needs a restart to apply: %s", ", ".join(pending_restart))
+        finally:
+            if conn:
+                conn.close()
+
+        state.INSTANCE.set_details("tuning", {
+            "role": role,
+            "cpus": self._cpus,
+            "memory_bytes": self._memory_bytes,
+            "storage_bytes": self._storage_bytes,
+            "changed": changed_settings,
+            "pending_restart": pending_restart
+        })
@@ -0,0 +1,83 @@
+import logging
+import socket
+import socketserver
+import threading
+
+from pg_controller import state
+
+
+def agent_status(expected_role=None):
+    """
+    Returns the status of the database in HAProxy's agent check format. The status is 'down' in case the controller is
+    not initialized, the role is 'DeadMaster' or differs from the expected one (if any), or the alive/standby
+    replication health check is failing. The status is 'up 0%' (i.e. draining, keeping the open connections only) in
+    case any other health check is failing, otherwise, 'up 100%'. The words 'ready', 'drain' and 'maint' are never
+    used, as they would override the administrative state set by consul-template.
+
+    :param expected_role: The role the asking HAProxy server expects (e.g. 'master'), or None for any role.
+    """
+    role = state.INSTANCE.role
+    if not state.INSTANCE.initialized or role == state.ROLE_DEAD_MASTER:
+        return "down"
+
+    if expected_role and expected_role.lower() != role.lower():
+        return "down"
+
+    for name in (state.ALIVE_HEALTH_CHECK_NAME, state.STANDBY_REPLICATION_HEALTH_CHECK_NAME):
+        if not state.INSTANCE.is_health_check_passing(name):
+            return "down"
+
+    return "up 100%" if state.INSTANCE.is_ready else "up 0%"
+
+
+class AgentCheckRequestHandler(socketserver.BaseRequestHandler):
+    """Handles HAProxy agent check requests."""
+
+    READ_TIMEOUT_SECONDS = 0.1
+
+    def handle(self):
+        """
+        Reads the expected role sent by HAProxy (see the 'agent-send' server option), if any, and responds with the
+        database's status.
+        """
+        expected_role = None
+        self.request.settimeout(self.READ_TIMEOUT_SECONDS)
+        try:
+            expected_role = self.request.recv(64).decode("utf-8", "replace").strip()
+        except socket.timeout:
+            pass
+
+        try:
+            self.request.sendall((agent_status(expected_role) + "\n").encode("utf-8"))
+        except OSError:
+            logging.exception("Could not respond to the agent check!")
+
+
+class MultiThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Handle each request in a separate thread."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class AgentCheckServer(threading.Thread):
+    """
+    Speaks HAProxy's agent check protocol over a specific port, so that the lb could probe the status of the database
+    directly (at sub-second intervals), rather than waiting for the changes to propagate through Consul.
+    """
+
+    def __init__(self, port):
+        """
+        :param port: The port to listen to for agent check requests.
+        """
+        super().__init__(name=self.__class__.__name__)
+        self._port = port
+        self._server = MultiThreadedTCPServer(("", self._port), AgentCheckRequestHandler)
+
+    def run(self):
+        self._server.serve_forever()
+        logging.info("Stopped!")
+
+    def stop(self):
+        logging.info("Stopping agent check server ...")
+        self._server.shutdown()
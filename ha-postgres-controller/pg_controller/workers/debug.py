@@ -0,0 +1,159 @@
+import collections
+import faulthandler
+import http.server
+import logging
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+import urllib.parse
+
+from pg_controller.workers.management import MultiThreadedHTTPServer
+
+
+def dump_thread_stacks():
+    """Returns the current stack of each thread within the process."""
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    dump = []
+    for thread_id, frame in sys._current_frames().items():
+        dump.append("Thread %s (%d):\n" % (thread_names.get(thread_id, "<unknown>"), thread_id))
+        dump.extend(traceback.format_stack(frame))
+        dump.append("\n")
+
+    return "".join(dump)
+
+
+def sample_profile(duration_seconds, sampling_interval_seconds, top):
+    """
+    Samples the stacks of all threads (except the calling one) periodically for the given duration, and returns the
+    functions that were most frequently found running (own) or on the stack (cumulative).
+    """
+    own_counts = collections.Counter()
+    cumulative_counts = collections.Counter()
+    sample_count = 0
+    current_thread_id = threading.get_ident()
+    end = time.monotonic() + duration_seconds
+    while time.monotonic() < end:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == current_thread_id:
+                continue
+
+            own_counts[_describe_frame(frame)] += 1
+            on_stack = set()
+            while frame:
+                on_stack.add(_describe_frame(frame))
+                frame = frame.f_back
+
+            cumulative_counts.update(on_stack)
+
+        sample_count += 1
+        time.sleep(sampling_interval_seconds)
+
+    report = ["%d samples taken over %.1fs\n" % (sample_count, duration_seconds)]
+    for title, counts in (("own", own_counts), ("cumulative", cumulative_counts)):
+        report.append("\nTop %d functions (%s samples):\n" % (top, title))
+        for function, count in counts.most_common(top):
+            report.append("%8d  %s\n" % (count, function))
+
+    return "".join(report)
+
+
+def _describe_frame(frame):
+    code = frame.f_code
+    return "%s:%d(%s)" % (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class DebugRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles debug API HTTP requests."""
+
+    MAX_PROFILE_SECONDS = 60
+    profile_lock = threading.Lock()
+
+    def do_GET(self):
+        """
+        Responds with the stacks of all threads for 'GET /debug/threads' requests, the result of sampling the process
+        for 'GET /debug/profile?seconds=N' requests, the top memory allocations (traced by tracemalloc) for
+        'GET /debug/tracemalloc?top=N' requests, otherwise, 404. Tracing memory allocations is started/stopped via
+        'GET /debug/tracemalloc/start' and 'GET /debug/tracemalloc/stop' requests.
+        """
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        try:
+            if url.path == "/debug/threads":
+                self._respond(200, dump_thread_stacks())
+            elif url.path == "/debug/profile":
+                self._profile(float(params.get("seconds", [5])[0]), int(params.get("top", [30])[0]))
+            elif url.path == "/debug/tracemalloc":
+                self._report_allocations(int(params.get("top", [30])[0]))
+            elif url.path == "/debug/tracemalloc/start":
+                tracemalloc.start()
+                self._respond(200, "Tracing memory allocations!")
+            elif url.path == "/debug/tracemalloc/stop":
+                tracemalloc.stop()
+                self._respond(200, "Stopped tracing memory allocations!")
+            else:
+                self._respond(404, "Endpoint not found!")
+        except ValueError:
+            self._respond(400, "Invalid parameters!")
+
+    def _profile(self, duration_seconds, top):
+        if not 0 < duration_seconds <= self.MAX_PROFILE_SECONDS:
+            self._respond(400, "The duration must be within (0, %d] seconds!" % self.MAX_PROFILE_SECONDS)
+            return
+
+        if not self.profile_lock.acquire(blocking=False):
+            self._respond(409, "Another profile is in progress!")
+            return
+
+        try:
+            self._respond(200, sample_profile(duration_seconds, 0.01, top))
+        finally:
+            self.profile_lock.release()
+
+    def _report_allocations(self, top):
+        if not tracemalloc.is_tracing():
+            self._respond(409, "Memory allocations are not being traced!")
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        report = ["Traced memory: current %d bytes, peak %d bytes\n" % (current, peak),
+                  "\nTop %d allocations:\n" % top]
+        report.extend("%s\n" % stat for stat in snapshot.statistics("lineno")[:top])
+        self._respond(200, "".join(report))
+
+    def _respond(self, response_code, body):
+        self.send_response(response_code)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(str(body).encode("utf-8"))
+
+    def log_message(self, msg_format, *args):
+        threading.current_thread().name = 'DebugServer'
+        logging.info(msg_format % args)
+
+
+class DebugServer(threading.Thread):
+    """
+    Exposes the debug HTTP API over a specific port on the loopback interface only (i.e. accessible only from within
+    the pod), and registers a SIGUSR1 handler that dumps the stacks of all threads to stderr.
+    """
+
+    def __init__(self, port):
+        """
+        :param port: The port to listen to for API requests.
+        """
+        super().__init__(name=self.__class__.__name__)
+        self._port = port
+        self._server = MultiThreadedHTTPServer(("127.0.0.1", self._port), DebugRequestHandler)
+        faulthandler.register(signal.SIGUSR1, all_threads=True)
+
+    def run(self):
+        self._server.serve_forever()
+        logging.info("Stopped!")
+
+    def stop(self):
+        logging.info("Stopping debug server ...")
+        self._server.shutdown()
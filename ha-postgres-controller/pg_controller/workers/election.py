@@ -1,10 +1,23 @@
 import logging
+import re
+import time
 from abc import ABC, abstractmethod
 
 import requests
 
 from pg_controller.workers import looping_thread
 
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+DURATION_PART_PATTERN = r"(\d+(?:\.\d+)?)(ms|s|m|h)"
+
+
+def parse_duration(duration):
+    """Parses a Consul (Go) duration (e.g. '1m30s'), and returns its value in seconds."""
+    if not re.fullmatch("(%s)+" % DURATION_PART_PATTERN, duration):
+        raise ValueError("Invalid duration: %s" % duration)
+
+    return sum(float(value) * DURATION_UNITS[unit] for value, unit in re.findall(DURATION_PART_PATTERN, duration))
+
 
 class ElectionStatusHandler(ABC):
 
@@ -18,19 +31,36 @@ class ElectionStatusHandler(ABC):
         """Return True to signal the Election thread to continue participating (to be implemented by subclasses)."""
         pass
 
+    @abstractmethod
+    def continue_watching(self):
+        """
+        Return True to signal the Election thread to keep watching the lock after it stopped participating as the
+        leader (to be implemented by subclasses).
+        """
+        pass
+
+    @abstractmethod
+    def handle_leadership_lost(self):
+        """Defines the logic to handle losing the lock held by the leader (to be implemented by subclasses)."""
+        pass
+
 
 class Election(looping_thread.LoopingThread):
     """
     Creates a Consul session associated with the controllers health checks, and keeps trying to acquire the lock over
-    the election key using the created session.
+    the election key using the created session. Once the lock is acquired, and the ElectionStatusHandler decides to
+    stop participating, it keeps watching the election key (using Consul blocking queries) to detect losing the lock.
     """
 
     CONSUL_BASE_URL = "http://localhost:8500/v1"
     CONSUL_SESSION_URL = CONSUL_BASE_URL + "/session/{}"
     CONSUL_KV_URL = CONSUL_BASE_URL + "/kv/{}"
+    WATCH_MARGIN_SECONDS = 0.2
+    WATCH_RETRY_TIMEOUT_SECONDS = 1
+    WATCH_RETRY_DELAY_SECONDS = 0.5
 
     def __init__(self, election_consul_key, consul_session_checks, election_status_handler, host_name, host_ip,
-                 check_interval_seconds):
+                 check_interval_seconds, session_lock_delay=None, session_behavior=None, session_ttl=None):
         """
          :param election_consul_key: The Consul key to acquire the lock over.
          :param consul_session_checks: The list of Consul check names to associate the session with.
@@ -38,6 +68,13 @@ class Election(looping_thread.LoopingThread):
          :param host_name: The host name to set in the election key's value if the lock was acquired.
          :param host_ip: The IP to set in the election key's value if the lock was acquired.
          :param check_interval_seconds: The time interval (in seconds) between two consecutive attempts.
+         :param session_lock_delay: The session's lock delay as a Consul duration, e.g. '15s' (Consul's default if
+                                    not set), which should be larger than the time it takes to detect losing the
+                                    lock (see max_lock_loss_detection_seconds).
+         :param session_behavior: The session's invalidation behavior, 'release' or 'delete' (Consul's default if not
+                                  set).
+         :param session_ttl: The session's TTL as a Consul duration, e.g. '30s' (no TTL if not set). The session gets
+                             renewed at each attempt, so the TTL should be larger than the check interval.
          """
         super().__init__(check_interval_seconds)
         self._election_consul_key = election_consul_key
@@ -45,40 +82,210 @@ class Election(looping_thread.LoopingThread):
         self._election_status_handler = election_status_handler
         self._host_name = host_name
         self._host_ip = host_ip
+        self._session_lock_delay = session_lock_delay
+        self._session_behavior = session_behavior
+        self._session_ttl = session_ttl
+        if session_lock_delay and self._parse_lock_delay(session_lock_delay) <= self.max_lock_loss_detection_seconds:
+            logging.warning("The session lock delay (%s) should be larger than %.1fs, otherwise, a new leader could be "
+                            "elected before this one detects losing the lock!", session_lock_delay,
+                            self.max_lock_loss_detection_seconds)
+
+        self._released = False
+        self._watching = False
+        self._watch_index = None
+        self._watch_failure_count = 0
+        self._last_confirmed = None
         self._create_consul_session()
 
+    @property
+    def max_lock_loss_detection_seconds(self):
+        """
+        Returns the maximum time (in seconds) it takes the leader to detect losing the lock in case it can not reach
+        Consul (i.e. the check interval, along with the time of retrying a failed query).
+        """
+        return self._interval_seconds + self.WATCH_RETRY_DELAY_SECONDS + self.WATCH_RETRY_TIMEOUT_SECONDS + \
+            self.WATCH_MARGIN_SECONDS
+
+    @staticmethod
+    def _parse_lock_delay(session_lock_delay):
+        try:
+            return parse_duration(session_lock_delay)
+        except ValueError:
+            logging.exception("Could not parse the session lock delay!")
+            return float("inf")
+
     def _create_consul_session(self):
         logging.info("Creating Consul session for leader election")
-        response = requests.put(self.CONSUL_SESSION_URL.format("create"),
-                                json={"Checks": self._consul_session_checks})
+        body = {"Checks": self._consul_session_checks}
+        if self._session_lock_delay:
+            body["LockDelay"] = self._session_lock_delay
+        if self._session_behavior:
+            body["Behavior"] = self._session_behavior
+        if self._session_ttl:
+            body["TTL"] = self._session_ttl
+
+        response = requests.put(self.CONSUL_SESSION_URL.format("create"), json=body,
+                                timeout=max(self.remaining_seconds(), 0.1))
 
         logging.info("Response (%d) %s", response.status_code, response.text)
         response.raise_for_status()
         
         self._session_id = response.json()["ID"]
 
+    def _renew_consul_session(self):
+        logging.info("Renewing Consul session")
+        response = requests.put(self.CONSUL_SESSION_URL.format("renew/" + self._session_id),
+                                timeout=max(self.remaining_seconds(), 0.1))
+
+        logging.info("Response (%d) %s", response.status_code, response.text)
+        if response.status_code != 404:
+            response.raise_for_status()
+
     def _acquire_lock(self):
         logging.info("Attempting to acquire lock over election key")
         response = requests.put(self.CONSUL_KV_URL.format(self._election_consul_key),
-                                params={"acquire": self._session_id}, json={
-                                    "host": self._host_ip,
-                                    "node": self._host_name
-                                })
+                                params={"acquire": self._session_id}, json=self._election_key_value(),
+                                timeout=max(self.remaining_seconds(), 0.1))
 
         logging.info("Response (%d) %s", response.status_code, response.text)
-        if response.status_code == 500 and "invalid session" in response.text:
+        if response.status_code == 500 and "invalid session" in response.text and not self._released:
             self._create_consul_session()
         else:
             response.raise_for_status()
 
         return response.text == "true"
 
+    def _election_key_value(self):
+        return {
+            "host": self._host_ip,
+            "node": self._host_name
+        }
+
+    def release_lock(self):
+        """
+        Releases the lock over the election key (if held by the created session), and destroys the session. This
+        allows other candidates to acquire the lock right away, rather than waiting for Consul to invalidate the
+        session (and for the session's lock delay to pass afterwards). The election stops after calling this method.
+        """
+        if self._released:
+            return
+
+        self._released = True
+        logging.info("Releasing the lock over the election key")
+        response = requests.put(self.CONSUL_KV_URL.format(self._election_consul_key),
+                                params={"release": self._session_id}, json=self._election_key_value(), timeout=5)
+        logging.info("Response (%d) %s", response.status_code, response.text)
+
+        logging.info("Destroying Consul session")
+        response = requests.put(self.CONSUL_SESSION_URL.format("destroy/" + self._session_id), timeout=5)
+        logging.info("Response (%d) %s", response.status_code, response.text)
+        response.raise_for_status()
+        self.stop()
+
+    def _is_lock_held(self, timeout_seconds, blocking):
+        """
+        Queries the election key, and returns True if it is still locked by the created session, otherwise, False. A
+        blocking query returns as soon as the key is modified (or the wait time elapses). As Consul adds a random time
+        of up to 1/16 of the wait time, the wait time is chosen such that the query finishes within the given timeout.
+        """
+        params = {}
+        if blocking:
+            params["wait"] = "%dms" % (timeout_seconds * 16 / 17 * 1000)
+            if self._watch_index:
+                params["index"] = self._watch_index
+
+        response = requests.get(self.CONSUL_KV_URL.format(self._election_consul_key), params=params,
+                                timeout=timeout_seconds)
+        if response.status_code == 404:
+            logging.warning("The election key was deleted!")
+            return False
+
+        response.raise_for_status()
+        self._watch_index = response.headers.get("X-Consul-Index")
+        return response.json()[0].get("Session") == self._session_id
+
+    def _watch_lock(self):
+        """
+        Keeps watching the lock over the election key till the deadline of the current run, and calls the
+        ElectionStatusHandler's handle_leadership_lost method as soon as the lock is lost. Failing to confirm that the
+        lock is held for longer than the check interval (e.g. due to a network partition from Consul) is also
+        considered as losing it, but only after a failed query got retried (using a quick non-blocking query). The
+        watch is resumed by the following runs, which (using the last seen index) would not miss any changes in
+        between.
+        """
+        while not self._exit.is_set():
+            if self._election_status_handler.continue_watching() is False:
+                logging.info("ElectionStatusHandler decided to stop watching the lock!")
+                self.stop()
+                return
+
+            timeout_seconds = self.remaining_seconds() - self.WATCH_MARGIN_SECONDS
+            if self._watch_failure_count == 0:
+                # Leaves enough time for retrying within the same run, in case the blocking query fails.
+                timeout_seconds -= self.WATCH_RETRY_DELAY_SECONDS + self.WATCH_RETRY_TIMEOUT_SECONDS
+
+            if timeout_seconds <= 0:
+                return
+
+            try:
+                if self._watch_failure_count > 0:
+                    is_lock_held = self._is_lock_held(min(timeout_seconds, self.WATCH_RETRY_TIMEOUT_SECONDS), False)
+                else:
+                    is_lock_held = self._is_lock_held(timeout_seconds, True)
+
+                if not is_lock_held:
+                    break
+
+                self._watch_failure_count = 0
+                self._last_confirmed = time.monotonic()
+            except:
+                logging.exception("An error occurred during watching the election key!")
+                self._watch_failure_count += 1
+                if self._watch_failure_count > 1 and \
+                        time.monotonic() - self._last_confirmed > self._interval_seconds:
+                    logging.error("Could not confirm holding the lock for more than %ds!", self._interval_seconds)
+                    break
+
+                self._exit.wait(max(min(self.remaining_seconds() - self.WATCH_MARGIN_SECONDS,
+                                        self.WATCH_RETRY_DELAY_SECONDS), 0))
+        else:
+            return
+
+        if self._released:
+            logging.info("The lock over the election key is released!")
+            return
+
+        logging.error("The lock over the election key is lost!")
+        try:
+            self._election_status_handler.handle_leadership_lost()
+        except:
+            logging.exception("An error occurred during handling the lost lock!")
+
+        self.stop()
+
     def do_one_run(self):
         """
         Attempts to acquire the lock over the election key using the created session, then passes the result to the
         ElectionStatusHandler's handle_status method. Finally, it evaluates the ElectionStatusHandler's
-        continue_participating method to decide whether to stop or not.
+        continue_participating method to decide whether to stop or not. If the lock was acquired, and the
+        ElectionStatusHandler decided to stop participating, the lock gets watched till it is lost. The session gets
+        renewed at the beginning of each run, in case it has a TTL.
         """
+        if self._released:
+            self.stop()
+            return
+
+        if self._session_ttl:
+            try:
+                self._renew_consul_session()
+            except:
+                logging.exception("An error occurred during renewing the Consul session!")
+
+        if self._watching:
+            self._watch_lock()
+            return
+
+        is_leader = False
         try:
             is_leader = self._acquire_lock()
             self._election_status_handler.handle_status(is_leader)
@@ -86,5 +293,12 @@ class Election(looping_thread.LoopingThread):
             logging.exception("An error occurred during leader election!")
 
         if self._election_status_handler.continue_participating() is False:
+            if is_leader and self._election_status_handler.continue_watching():
+                logging.info("Watching the lock over the election key")
+                self._watching = True
+                self._last_confirmed = time.monotonic()
+                self._watch_lock()
+                return
+
             logging.info("ElectionStatusHandler decided to stop the election loop!")
             self.stop()
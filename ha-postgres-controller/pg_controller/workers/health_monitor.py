@@ -6,6 +6,18 @@ import requests
 from pg_controller.workers import looping_thread
 
 
+class Probe(ABC):
+    """A base class for probes, which collect the signals that a HealthMonitor's checks evaluate."""
+
+    @abstractmethod
+    def collect(self, timeout):
+        """
+        Collects a snapshot of the signals, which should finish within the given timeout (to be implemented by
+        subclasses).
+        """
+        pass
+
+
 class HealthCheck(ABC):
     """A base class that simplifies implementing health checks."""
 
@@ -23,14 +35,16 @@ class HealthCheck(ABC):
     def check_name(self):
         return self._check_name
 
-    def do_health_check(self):
+    def do_health_check(self, snapshot):
         """
         Executes the check defined by do_health_check_impl, and keeps track of the failure counts. This method
         returns True only if the number of failures exceeds the threshold set, otherwise, False.
+
+        :param snapshot: The snapshot collected by the probe, or None if collecting it failed.
         """
         is_passing = False
         try:
-            is_passing = self.do_health_check_impl()
+            is_passing = self.do_health_check_impl(snapshot)
         except:
             logging.exception("An error occurred during health check!")
 
@@ -41,8 +55,11 @@ class HealthCheck(ABC):
         return self._failure_count < self._failure_threshold
 
     @abstractmethod
-    def do_health_check_impl(self):
-        """Defines the check logic (to be implemented by subclasses)."""
+    def do_health_check_impl(self, snapshot):
+        """
+        Defines the check logic, which evaluates the check's view of the given snapshot (to be implemented by
+        subclasses).
+        """
         pass
 
     @abstractmethod
@@ -63,28 +80,37 @@ class HealthCheck(ABC):
 
 class HealthMonitor(looping_thread.LoopingThread):
     """
-    Defines a Consul TTL check, keeps executing the supplied HealthCheck, and updates the Consul check status
-    accordingly.
+    Defines a Consul TTL check for each of the supplied HealthChecks, and keeps collecting a snapshot through the
+    supplied Probe, which is shared by all checks (so that adding checks does not add load on the monitored service).
+    The Consul check statuses are updated according to the checks' evaluation of each snapshot.
     """
 
     CONSUL_BASE_URL = "http://localhost:8500/v1"
     CONSUL_REGISTER_CHECK_URL = CONSUL_BASE_URL + "/agent/check/register"
     CONSUL_UPDATE_CHECK_URL = CONSUL_BASE_URL + "/agent/check/update/{}"
+    CONSUL_UPDATE_TIME_RATIO = 0.2
 
-    def __init__(self, health_check, check_interval_seconds):
+    def __init__(self, probe, health_checks, check_interval_seconds, check_jitter_seconds=0,
+                 check_timeout_seconds=None):
         """
-        :param health_check: A HealthCheck instance that implements the check logic.
+        :param probe: A Probe instance that collects the snapshot evaluated by the checks.
+        :param health_checks: A list of HealthCheck instances that implement the checks logic.
         :param check_interval_seconds: The time interval (in seconds) between two consecutive checks.
+        :param check_jitter_seconds: The maximum random delay (in seconds) added to each scheduled check.
+        :param check_timeout_seconds: The time (in seconds) a check, along with updating Consul's checks, is given to
+                                      finish (defaults to check_interval_seconds).
         """
-        super().__init__(check_interval_seconds)
-        self._health_check = health_check
-        self._create_consul_check()
+        super().__init__(check_interval_seconds, check_jitter_seconds, check_timeout_seconds)
+        self._probe = probe
+        self._health_checks = list(health_checks)
+        for health_check in self._health_checks:
+            self._create_consul_check(health_check)
 
-    def _create_consul_check(self):
+    def _create_consul_check(self, health_check):
         ttl = self._interval_seconds + 5
-        logging.info("Creating Consul TTL check: %s, with TTL: %ds", self._health_check.check_name, ttl)
+        logging.info("Creating Consul TTL check: %s, with TTL: %ds", health_check.check_name, ttl)
         body = {
-            "Name": self._health_check.check_name,
+            "Name": health_check.check_name,
             "TTL": "%ds" % ttl,
         }
 
@@ -92,28 +118,41 @@ class HealthMonitor(looping_thread.LoopingThread):
         logging.info("Response (%d) %s", response.status_code, response.text)
         response.raise_for_status()
 
-    def _update_consul_check(self, is_passing):
+    def _update_consul_check(self, health_check, is_passing):
         status = "passing" if is_passing else "critical"
-        logging.info("Updating Consul TTL check: %s, with status: %s", self._health_check.check_name, status)
-        response = requests.put(self.CONSUL_UPDATE_CHECK_URL.format(self._health_check.check_name),
-                                json={"Status": status})
+        logging.info("Updating Consul TTL check: %s, with status: %s", health_check.check_name, status)
+        response = requests.put(self.CONSUL_UPDATE_CHECK_URL.format(health_check.check_name),
+                                json={"Status": status}, timeout=max(self.remaining_seconds(), 0.1))
 
         logging.info("Response (%d) %s", response.status_code, response.text)
         response.raise_for_status()
 
     def do_one_run(self):
         """
-        Executes the supplied HealthCheck's do_health_check method, then passes the result to the HealthCheck's
-        handle_status method, It also updates the Consul check status with the result, and finally, evaluates the
-        HealthCheck's continue_checking method to decide whether to stop or not.
+        Collects a snapshot through the supplied Probe (leaving a share of the run's time for updating Consul's checks,
+        so that a slow probe does not make them miss their TTL), then executes each HealthCheck's do_health_check
+        method against it, and passes the result to the HealthCheck's handle_status method. It also updates the Consul
+        check status with the result, and finally, evaluates the HealthCheck's continue_checking method to decide
+        whether to keep executing it or not. The monitoring loop stops once no HealthCheck is left.
         """
-        is_passing = self._health_check.do_health_check()
+        snapshot = None
         try:
-            self._update_consul_check(is_passing)
+            snapshot = self._probe.collect(self.remaining_seconds() * (1 - self.CONSUL_UPDATE_TIME_RATIO))
         except:
-            logging.exception("An error occurred during updating Consul's check!")
-
-        self._health_check.handle_status(is_passing)
-        if self._health_check.continue_checking() is False:
-            logging.info("HealthCheck decided to stop the monitoring loop!")
+            logging.exception("An error occurred during collecting the snapshot!")
+
+        for health_check in list(self._health_checks):
+            is_passing = health_check.do_health_check(snapshot)
+            try:
+                self._update_consul_check(health_check, is_passing)
+            except:
+                logging.exception("An error occurred during updating Consul's check!")
+
+            health_check.handle_status(is_passing)
+            if health_check.continue_checking() is False:
+                logging.info("HealthCheck %s decided to stop!", health_check.check_name)
+                self._health_checks.remove(health_check)
+
+        if not self._health_checks:
+            logging.info("No HealthCheck is left, stopping the monitoring loop!")
             self.stop()
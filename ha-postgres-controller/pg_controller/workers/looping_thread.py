@@ -1,30 +1,82 @@
 import logging
+import math
+import random
 import threading
+import time
 
 
 class LoopingThread(threading.Thread):
-    """A base class that helps in implementing repeating tasks."""
+    """
+    A base class that helps in implementing repeating tasks. The tasks are scheduled at a fixed rate (i.e. the time a
+    task takes does not delay the following ones), and each task execution is given a deadline, which it is expected
+    to respect (see remaining_seconds). Executions exceeding their deadline are counted as overruns.
+    """
 
-    def __init__(self, interval_seconds):
+    def __init__(self, interval_seconds, jitter_seconds=0, run_timeout_seconds=None):
         """
-        :param interval_seconds: The time interval (in seconds) between two consecutive task executions.
+        :param interval_seconds: The time interval (in seconds) between the start of two consecutive task executions.
+        :param jitter_seconds: The maximum random delay (in seconds) added to each scheduled task execution.
+        :param run_timeout_seconds: The time (in seconds) a task execution is given before its deadline (defaults to
+                                    interval_seconds).
         """
         super().__init__(name=self.__class__.__name__)
         self._exit = threading.Event()
         self._interval_seconds = interval_seconds
+        self._jitter_seconds = jitter_seconds
+        self._run_timeout_seconds = min(run_timeout_seconds or interval_seconds, interval_seconds)
+        self._run_deadline = None
+        self._last_run_seconds = None
+        self._overrun_count = 0
+        self._missed_run_count = 0
 
     def do_one_run(self):
         """Defines the task logic (to be implemented by subclasses)."""
         pass
 
+    def remaining_seconds(self):
+        """
+        Returns the time left (in seconds) till the deadline of the current task execution, or the whole run timeout if
+        no task is executed yet.
+        """
+        if self._run_deadline is None:
+            return self._run_timeout_seconds
+
+        return max(self._run_deadline - time.monotonic(), 0)
+
+    @property
+    def stats(self):
+        """Returns the scheduling statistics of this thread."""
+        return {
+            "interval_seconds": self._interval_seconds,
+            "run_timeout_seconds": self._run_timeout_seconds,
+            "last_run_seconds": self._last_run_seconds,
+            "overrun_count": self._overrun_count,
+            "missed_run_count": self._missed_run_count
+        }
+
     def run(self):
+        next_run = time.monotonic()
         while not self._exit.is_set():
+            run_start = time.monotonic()
+            self._run_deadline = run_start + self._run_timeout_seconds
             self.do_one_run()
-            self._exit.wait(self._interval_seconds)
+            self._last_run_seconds = time.monotonic() - run_start
+            if self._last_run_seconds > self._run_timeout_seconds:
+                self._overrun_count += 1
+                logging.warning("Run took %.3fs, exceeding its deadline of %.3fs!", self._last_run_seconds,
+                                self._run_timeout_seconds)
+
+            next_run += self._interval_seconds
+            now = time.monotonic()
+            if next_run < now:
+                missed_runs = math.ceil((now - next_run) / self._interval_seconds)
+                self._missed_run_count += missed_runs
+                next_run += missed_runs * self._interval_seconds
+
+            self._exit.wait(next_run - now + random.uniform(0, self._jitter_seconds))
 
         logging.info("Stopped!")
 
     def stop(self):
         logging.info("Stopping %s thread...", self.name)
         self._exit.set()
-
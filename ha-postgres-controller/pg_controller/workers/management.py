@@ -1,9 +1,11 @@
 import http.server
+import json
 import logging
 import socketserver
 import threading
 
 from pg_controller import state
+from pg_controller.workers.looping_thread import LoopingThread
 
 
 class ManagementRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -12,20 +14,28 @@ class ManagementRequestHandler(http.server.BaseHTTPRequestHandler):
     def do_GET(self):
         """
         Responds with the database role for 'GET /controller/role' requests, the database readiness for
-        'GET controller/ready' requests, otherwise, 404.
+        'GET controller/ready' requests, the scheduling statistics of the worker threads for 'GET /controller/workers'
+        requests, the details reported by the controller's workers for 'GET /controller/details' requests, otherwise,
+        404.
         """
         if self.path == "/controller/ready":
             response_code = 200 if state.INSTANCE.is_ready else 503
             self._respond(response_code)
         elif self.path == "/controller/role":
             self._respond(200, state.INSTANCE.role)
+        elif self.path == "/controller/workers":
+            workers = {worker.name: worker.stats for worker in self.server.worker_threads
+                       if isinstance(worker, LoopingThread)}
+            self._respond(200, json.dumps(workers), "application/json")
+        elif self.path == "/controller/details":
+            self._respond(200, json.dumps(state.INSTANCE.details), "application/json")
         else:
             self._respond(404, "Endpoint not found!")
 
-    def _respond(self, response_code, body=None):
+    def _respond(self, response_code, body=None, content_type="text/plain"):
         self.send_response(response_code)
         if body:
-            self.send_header('Content-type', 'text/plain')
+            self.send_header('Content-type', content_type)
             self.end_headers()
             self.wfile.write(str(body).encode("utf-8"))
         else:
@@ -43,13 +53,15 @@ class MultiThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServe
 class ManagementServer(threading.Thread):
     """Exposes the management HTTP API over a specific port."""
 
-    def __init__(self, port):
+    def __init__(self, port, worker_threads):
         """
         :param port: The port to listen to for API requests.
+        :param worker_threads: The list of the controller's worker threads, whose statistics are to be exposed.
         """
         super().__init__(name=self.__class__.__name__)
         self._port = port
         self._server = MultiThreadedHTTPServer(("", self._port), ManagementRequestHandler)
+        self._server.worker_threads = worker_threads
 
     def run(self):
         self._server.serve_forever()
@@ -29,6 +29,13 @@ if [ "$ROLE" == "Standby" ] && [ -z "$(find $PGDATA -type f -print -quit)" ]; th
 	unset PGPASSWORD
 fi
 
+if [ "$ROLE" == "Standby" ] && [ "$REPLICATION_SLOTS_ENABLED" == "true" ]; then
+	slot_name=$(echo ha_standby_$(hostname) | tr 'A-Z' 'a-z' | sed 's/[^a-z0-9_]/_/g' | cut -c1-63)
+	echo "Using replication slot $slot_name..."
+	sed -i '/^primary_slot_name/d' $PGDATA/postgresql.auto.conf
+	echo "primary_slot_name = '$slot_name'" >> $PGDATA/postgresql.auto.conf
+fi
+
 cp /master-init.sh /docker-entrypoint-initdb.d/0-master-init.sh
 for file in $(find /user-defined-init-scripts -type f); do
 	cp $file /docker-entrypoint-initdb.d/1-user-defined-$(basename $file)
@@ -8,6 +8,15 @@ if [ -n "$SEED_DB_HOST" ]; then
 	seed_db_password="${PASSWORD_SEED_DB_USER:-$PASSWORD_SUPER_USER}"
 	seed_db_conn_url="host=$SEED_DB_HOST port=$seed_db_port dbname=$seed_db_name user=$seed_db_user password=$seed_db_password"
 	seed_db_publication=${SEED_DB_PUBLICATION:-seed}
+	if [ -n "$SEED_DB_SYNCWORKERS" ]; then
+		echo "Configuring $SEED_DB_SYNCWORKERS parallel table sync workers..."
+		psql -v ON_ERROR_STOP=1 -U $POSTGRES_USER -d $POSTGRES_DB <<-EOF
+			ALTER SYSTEM SET max_sync_workers_per_subscription = $SEED_DB_SYNCWORKERS;
+			ALTER SYSTEM SET max_logical_replication_workers = $(($SEED_DB_SYNCWORKERS + 2));
+			ALTER SYSTEM SET max_worker_processes = $(($SEED_DB_SYNCWORKERS + 8));
+			SELECT pg_reload_conf();
+		EOF
+	fi
 	psql -U $POSTGRES_USER -d $POSTGRES_DB \
 		-c "CREATE SUBSCRIPTION seed_from CONNECTION '$seed_db_conn_url' PUBLICATION $seed_db_publication"
 fi
\ No newline at end of file
@@ -7,11 +7,12 @@ psql -v ON_ERROR_STOP=1 -U $POSTGRES_USER -d $POSTGRES_DB <<-EOF
 	ALTER SYSTEM SET recovery_target_timeline = 'latest';
 
 	CREATE ROLE replication WITH REPLICATION LOGIN PASSWORD '$PASSWORD_REPLICATION_USER';
-	CREATE ROLE controller WITH LOGIN;
+	CREATE ROLE controller WITH LOGIN REPLICATION;
 
 	CREATE PUBLICATION seed FOR ALL TABLES;
 
 	GRANT EXECUTE ON FUNCTION pg_promote TO controller;
+	GRANT pg_monitor TO controller;
 
 	CREATE FUNCTION public.wal_receiver_status() RETURNS text AS '
 	  SELECT status FROM pg_catalog.pg_stat_wal_receiver;
@@ -21,6 +22,15 @@ psql -v ON_ERROR_STOP=1 -U $POSTGRES_USER -d $POSTGRES_DB <<-EOF
 	GRANT EXECUTE ON FUNCTION public.wal_receiver_status TO controller;
 EOF
 
+if [ -n "$WAL_ARCHIVE_TARGET" ]; then
+	echo "Configuring WAL archiving to $WAL_ARCHIVE_TARGET..."
+	psql -v ON_ERROR_STOP=1 -U $POSTGRES_USER -d $POSTGRES_DB <<-EOF
+		ALTER SYSTEM SET archive_mode = 'on';
+		ALTER SYSTEM SET archive_command = '/wal-archive.sh push %p %f';
+		ALTER SYSTEM SET restore_command = '/wal-archive.sh fetch %f %p';
+	EOF
+fi
+
 tee $PGDATA/pg_hba.conf <<-EOF
 	# TYPE  DATABASE        USER            ADDRESS                 METHOD
 	host    all             all             127.0.0.1/32            trust
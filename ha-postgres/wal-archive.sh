@@ -0,0 +1,186 @@
+#!/bin/bash
+
+# Archives/restores WAL files to/from the archive target $WAL_ARCHIVE_TARGET, which is either a filesystem path
+# (file:///path, e.g. a shared volume) or an object store compatible HTTP endpoint (http(s)://host/prefix) accepting
+# PUT/GET requests. WAL files are stored gzipped. An already archived WAL file is never overwritten: pushing it again
+# succeeds if the archived contents are identical, and fails otherwise (the HTTP endpoint needs to support conditional
+# PUT requests through 'If-None-Match: *').
+#
+# Usage:
+#   wal-archive.sh push <path> <file name>    (archive_command = '/wal-archive.sh push %p %f')
+#   wal-archive.sh fetch <file name> <path>   (restore_command = '/wal-archive.sh fetch %f %p')
+#
+# While pushing a WAL file, up to $WAL_ARCHIVE_PARALLELISM - 1 other WAL files that are ready to be archived are
+# compressed and uploaded in parallel, so that the following push commands return right away. Similarly, while
+# fetching a WAL segment, the following segments are prefetched in parallel (in the background) into a spool dir.
+
+target=${WAL_ARCHIVE_TARGET:?The WAL archive target is not set!}
+parallelism=${WAL_ARCHIVE_PARALLELISM:-4}
+segments_per_log=$((4096 / ${WAL_ARCHIVE_SEGMENT_SIZE_MB:-16}))
+spool_dir=${WAL_ARCHIVE_SPOOL_DIR:-/var/lib/postgresql/wal-spool}
+
+function verify_archived() {
+	local archived_file=$1 wal_path=$2 wal_name=$3
+	if gunzip -c $archived_file | cmp -s - $wal_path; then
+		echo "WAL file $wal_name was already archived with identical contents"
+		return 0
+	fi
+	echo "WAL file $wal_name was already archived with different contents!" >&2
+	return 1
+}
+
+function upload_file() {
+	local compressed_file=$1 wal_path=$2 wal_name=$3
+	local archived_file=${target#file://}/$wal_name.gz
+	if [ -f $archived_file ]; then
+		verify_archived $archived_file $wal_path $wal_name
+		return
+	fi
+
+	# The WAL file is linked from a complete temp file, which fails (rather than overwriting) if it already exists
+	local tmp_file
+	tmp_file=$(mktemp ${target#file://}/.$wal_name.gz.XXXXXX) || return
+	cp $compressed_file $tmp_file && chmod 644 $tmp_file && ln $tmp_file $archived_file 2>/dev/null \
+		|| { [ -f $archived_file ] && verify_archived $archived_file $wal_path $wal_name; }
+	local status=$?
+	rm -f $tmp_file
+	return $status
+}
+
+function upload_http() {
+	local compressed_file=$1 wal_path=$2 wal_name=$3
+	local http_status
+	http_status=$(curl -sS --retry 2 -o /dev/null -w '%{http_code}' -H 'If-None-Match: *' -T $compressed_file \
+		$target/$wal_name.gz)
+	case $http_status in
+		2??)
+			return 0
+			;;
+		412)
+			curl -fsS -o $compressed_file.archived $target/$wal_name.gz \
+				&& verify_archived $compressed_file.archived $wal_path $wal_name
+			local status=$?
+			rm -f $compressed_file.archived
+			return $status
+			;;
+		*)
+			echo "Could not upload WAL file $wal_name (HTTP status: $http_status)!" >&2
+			return 1
+			;;
+	esac
+}
+
+function upload() {
+	local wal_path=$1 wal_name=$2
+	local compressed_file=$spool_dir/push/$wal_name.gz
+	gzip -c $wal_path > $compressed_file || return
+	case $target in
+		file://*)
+			upload_file $compressed_file $wal_path $wal_name
+			;;
+		*)
+			upload_http $compressed_file $wal_path $wal_name
+			;;
+	esac
+	local status=$?
+	rm -f $compressed_file
+	return $status
+}
+
+function download() {
+	local wal_name=$1 wal_path=$2
+	case $target in
+		file://*)
+			cp ${target#file://}/$wal_name.gz $wal_path.gz.tmp
+			;;
+		*)
+			curl -fsS -o $wal_path.gz.tmp $target/$wal_name.gz
+			;;
+	esac && gunzip -c $wal_path.gz.tmp > $wal_path.tmp && mv $wal_path.tmp $wal_path
+	local status=$?
+	rm -f $wal_path.gz.tmp $wal_path.tmp
+	return $status
+}
+
+function is_segment() {
+	[[ $1 =~ ^[0-9A-F]{24}$ ]]
+}
+
+function next_segment() {
+	local timeline=${1:0:8} log=$((16#${1:8:8})) seg=$((16#${1:16:8} + 1))
+	if [ $seg -ge $segments_per_log ]; then
+		log=$((log + 1))
+		seg=0
+	fi
+	printf "%s%08X%08X" $timeline $log $seg
+}
+
+function push() {
+	local wal_path=$1 wal_name=$2
+	mkdir -p $spool_dir/push $spool_dir/pushed
+	if [ -f $spool_dir/pushed/$wal_name ]; then
+		echo "WAL file $wal_name was already archived in parallel"
+		rm -f $spool_dir/pushed/$wal_name
+		return 0
+	fi
+
+	local wal_dir=$(dirname $wal_path)
+	local other_names=$(ls $wal_dir/archive_status 2>/dev/null | sed -n 's/\.ready$//p' | grep -vx $wal_name | sort \
+		| head -n $((parallelism - 1)))
+	for other_name in $other_names; do
+		(upload $wal_dir/$other_name $other_name && touch $spool_dir/pushed/$other_name) &
+	done
+
+	upload $wal_path $wal_name
+	local status=$?
+	wait
+	return $status
+}
+
+function prefetch() {
+	local next_name=$1
+	mkdir -p $spool_dir/fetching
+	for i in $(seq 2 $parallelism); do
+		next_name=$(next_segment $next_name)
+		if [ ! -f $spool_dir/fetched/$next_name ] && mkdir $spool_dir/fetching/$next_name 2>/dev/null; then
+			(download $next_name $spool_dir/fetched/$next_name; rmdir $spool_dir/fetching/$next_name) \
+				< /dev/null > /dev/null 2>&1 &
+		fi
+	done
+}
+
+function fetch() {
+	local wal_name=$1 wal_path=$2
+	if ! is_segment $wal_name; then
+		download $wal_name $wal_path
+		return
+	fi
+
+	mkdir -p $spool_dir/fetched
+	for spooled_name in $(ls $spool_dir/fetched); do
+		if is_segment $spooled_name && [[ $spooled_name < $wal_name ]]; then
+			rm -f $spool_dir/fetched/$spooled_name
+		fi
+	done
+
+	if [ -f $spool_dir/fetched/$wal_name ]; then
+		mv $spool_dir/fetched/$wal_name $wal_path || return
+	else
+		download $wal_name $wal_path || return
+	fi
+
+	prefetch $wal_name
+}
+
+case $1 in
+	push)
+		push $2 $3
+		;;
+	fetch)
+		fetch $2 $3
+		;;
+	*)
+		echo "Usage: $0 push <path> <file name> | fetch <file name> <path>" >&2
+		exit 2
+		;;
+esac
@@ -0,0 +1,252 @@
+import argparse
+import json
+import logging
+import math
+import threading
+import time
+
+import psycopg2
+
+import test_utils
+
+
+class Worker(threading.Thread):
+    """
+    Keeps executing a query through the lb (reconnecting whenever the connection breaks), and records the outcome of
+    each attempt along with the time it took to reconnect after each break.
+    """
+
+    def __init__(self, worker_id, port, table_name, query_interval):
+        super().__init__(name="%s-%d" % (self.__class__.__name__, worker_id))
+        self.worker_id = worker_id
+        self.port = port
+        self.table_name = table_name
+        self.query_interval = query_interval
+        self.attempts = []
+        self.reconnect_latencies = []
+        self._conn = None
+        self._disconnected_at = None
+        self._exit = threading.Event()
+
+    def execute(self, cursor):
+        """Executes the query (to be implemented by subclasses)."""
+        pass
+
+    def _connect(self):
+        self._conn = psycopg2.connect(user=test_utils.PG_USER, password=test_utils.PG_PASS,
+                                      database=test_utils.PG_DB, host=test_utils.LB_SVC_IP, port=self.port,
+                                      connect_timeout=2)
+        self._conn.autocommit = True
+        if self._disconnected_at is not None:
+            self.reconnect_latencies.append(time.time() - self._disconnected_at)
+            self._disconnected_at = None
+
+    def _disconnect(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+        if self._disconnected_at is None:
+            self._disconnected_at = time.time()
+
+    def run(self):
+        while not self._exit.is_set():
+            try:
+                if self._conn is None:
+                    self._connect()
+
+                self.execute(self._conn.cursor())
+                self.attempts.append((time.time(), True))
+            except psycopg2.Error:
+                self.attempts.append((time.time(), False))
+                self._disconnect()
+
+            self._exit.wait(self.query_interval)
+
+        self._disconnect()
+
+    def stop(self):
+        self._exit.set()
+
+
+class Writer(Worker):
+    """Inserts sequentially numbered rows, and keeps track of the acknowledged ones."""
+
+    def __init__(self, worker_id, table_name, query_interval):
+        super().__init__(worker_id, test_utils.MASTER_DB_PORT, table_name, query_interval)
+        self.acknowledged = set()
+        self._seq = 0
+
+    def execute(self, cursor):
+        self._seq += 1
+        cursor.execute("INSERT INTO " + self.table_name + " (worker, seq) VALUES (%s, %s)",
+                       (self.worker_id, self._seq))
+        self.acknowledged.add((self.worker_id, self._seq))
+
+
+class Reader(Worker):
+    """Reads the latest row written by one of the writers from the standbys."""
+
+    def __init__(self, worker_id, table_name, query_interval):
+        super().__init__(worker_id, test_utils.STANDBY_DB_PORT, table_name, query_interval)
+
+    def execute(self, cursor):
+        cursor.execute("SELECT max(seq) FROM " + self.table_name + " WHERE worker = %s", (self.worker_id,))
+        cursor.fetchall()
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[math.ceil(percent / 100 * len(values)) - 1]
+
+
+def summarize(workers, kill_time, stop_time):
+    """
+    Summarizes the attempts of the given workers. The outage window is the longest period (after the kill) without any
+    successful attempt across all workers. In case the workers did not recover (i.e. no attempt succeeded after the
+    kill, or the attempts after the last successful one failed), the window is closed at the time they were stopped.
+    """
+    attempts = sorted(attempt for worker in workers for attempt in worker.attempts)
+    reconnect_latencies = [latency for worker in workers for latency in worker.reconnect_latencies]
+
+    outage_start, outage_seconds = None, 0
+    last_success, failed_since_last_success = None, False
+    for attempt_time, is_success in attempts:
+        if not is_success:
+            failed_since_last_success = True
+            continue
+
+        if last_success is not None and attempt_time > kill_time and attempt_time - last_success > outage_seconds:
+            outage_start, outage_seconds = last_success, attempt_time - last_success
+
+        last_success, failed_since_last_success = attempt_time, False
+
+    recovered = last_success is not None and last_success > kill_time and not failed_since_last_success
+    if not recovered:
+        open_outage_start = last_success if last_success is not None else kill_time
+        if stop_time - open_outage_start > outage_seconds:
+            outage_start, outage_seconds = open_outage_start, stop_time - open_outage_start
+
+    return {
+        "attempts": len(attempts),
+        "errors": len([attempt for attempt in attempts if not attempt[1]]),
+        "outage_seconds": outage_seconds,
+        "outage_start_after_kill_seconds": outage_start - kill_time if outage_start is not None else None,
+        "recovered": recovered,
+        "reconnects": len(reconnect_latencies),
+        "reconnect_latency_seconds": {
+            "p50": percentile(reconnect_latencies, 50),
+            "p95": percentile(reconnect_latencies, 95),
+            "max": max(reconnect_latencies, default=None)
+        }
+    }
+
+
+def get_master_pod():
+    servers = test_utils.get_lb_backend_servers("master")
+    enabled_servers = [server for server in servers if server[2] == '2']
+    if not enabled_servers:
+        return None
+
+    return test_utils.get_pod_name_by_ip(enabled_servers[0][1])
+
+
+def wait_for_new_master(old_master_pod, timeout):
+    end = time.time() + timeout
+    while time.time() < end:
+        master_pod = get_master_pod()
+        if master_pod is not None and master_pod != old_master_pod:
+            return master_pod
+
+        time.sleep(1)
+
+    return None
+
+
+def count_lost_writes(table_name, writers):
+    rows = test_utils.execute_query(test_utils.LB_SVC_IP, test_utils.MASTER_DB_PORT,
+                                    "SELECT worker, seq FROM " + table_name)
+    persisted = set(rows)
+    return sum(len(writer.acknowledged - persisted) for writer in writers)
+
+
+def run_benchmark(args):
+    table_name = "failover_benchmark_%d" % time.time()
+    logging.info("Creating new table %s", table_name)
+    test_utils.execute_query(test_utils.LB_SVC_IP, test_utils.MASTER_DB_PORT,
+                             "CREATE TABLE " + table_name + " (worker INT, seq INT, PRIMARY KEY (worker, seq))")
+
+    writers = [Writer(i, table_name, args.query_interval) for i in range(args.writers)]
+    readers = [Reader(i % max(args.writers, 1), table_name, args.query_interval) for i in range(args.readers)]
+    logging.info("Starting %d writers and %d readers", len(writers), len(readers))
+    for worker in writers + readers:
+        worker.start()
+
+    time.sleep(args.warmup)
+    old_master_pod = get_master_pod()
+    kill_time = time.time()
+    logging.info("Killing the master db pod %s (%s)", old_master_pod, args.kill_method)
+    if args.kill_method == "stress":
+        test_utils.start_db_pod_stress(old_master_pod)
+    else:
+        test_utils.stop_db_pod_postgres(old_master_pod)
+
+    new_master_pod = wait_for_new_master(old_master_pod, args.failover_timeout)
+    failover_seconds = None
+    if new_master_pod is None:
+        logging.error("No new master was elected within %ds!", args.failover_timeout)
+    else:
+        failover_seconds = time.time() - kill_time
+        logging.info("New master db pod %s was elected after %.1fs", new_master_pod, failover_seconds)
+        time.sleep(args.cooldown)
+
+    stop_time = time.time()
+    for worker in writers + readers:
+        worker.stop()
+    for worker in writers + readers:
+        worker.join()
+
+    return {
+        "config": vars(args),
+        "old_master": old_master_pod,
+        "new_master": new_master_pod,
+        "failover": new_master_pod is not None,
+        "lb_failover_seconds": failover_seconds,
+        "writes": summarize(writers, kill_time, stop_time),
+        "reads": summarize(readers, kill_time, stop_time),
+        "lost_acknowledged_writes": count_lost_writes(table_name, writers)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the client visible downtime of a master failover, through '
+                                                 'the lb service (the master db pod is left dead afterwards)')
+    parser.add_argument('--writers', type=int, default=20, help='The number of concurrent sessions writing to master')
+    parser.add_argument('--readers', type=int, default=20, help='The number of concurrent sessions reading standbys')
+    parser.add_argument('--query-interval', type=float, default=0.05,
+                        help='The time (in seconds) each session waits between two consecutive queries')
+    parser.add_argument('--warmup', type=float, default=10,
+                        help='The time (in seconds) to generate load before killing the master')
+    parser.add_argument('--cooldown', type=float, default=20,
+                        help='The time (in seconds) to keep generating load after the new master is elected')
+    parser.add_argument('--failover-timeout', type=float, default=120,
+                        help='The maximum time (in seconds) to wait for a new master to be elected')
+    parser.add_argument('--kill-method', choices=['stop', 'stress'], default='stress',
+                        help='Kill the master by overloading its cpu, or by stopping postgres (immediate mode), which '
+                             'might not cause a failover, as postgres is restarted as master right away')
+    parser.add_argument('--output', help='The file to write the results to as JSON (stdout if not set)')
+    args = parser.parse_args()
+
+    results = json.dumps(run_benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(results)
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 import logging
+import time
 import unittest
 
 from kubernetes import client, stream
 from psycopg2 import OperationalError
+from psycopg2.errors import ReadOnlySqlTransaction
 from retry.api import retry_call
 
 import test_utils
@@ -119,6 +121,40 @@ class IntegrationTest(unittest.TestCase):
         logging.info("Check that the lb accepts new connections for the standby backend")
         test_utils.open_db_conn(test_utils.LB_SVC_IP, test_utils.STANDBY_DB_PORT)[0].close()
 
+    def test6_lost_lock_fencing(self):
+        master_pod_name, master_pod_ip = self.assert_lb_backend_state("master", 1)[0]
+        table_name, _ = test_utils.create_table()
+        insert_query = "INSERT INTO " + table_name + " VALUES (0, 'X')"
+
+        logging.info("Checking that the healthy master %s is not fenced over several check intervals", master_pod_name)
+        end = time.time() + 35
+        while time.time() < end:
+            test_utils.execute_query(master_pod_ip, 5432, insert_query)
+            self.assertEqual(master_pod_ip, self.assert_lb_backend_state("master", 1)[0][1])
+            time.sleep(5)
+
+        test_utils.destroy_db_pod_consul_sessions(master_pod_name)
+
+        logging.info("Checking that the old master rejects writes, while postgres is still up")
+        retry_call(self.assert_db_is_read_only, fargs=[master_pod_ip, insert_query], tries=10, delay=1)
+        test_utils.execute_query(master_pod_ip, 5432, "SELECT 1")
+
+        logging.info("Checking that a new master is elected, and that it accepts writes")
+        new_master_pod_ip = retry_call(self.assert_new_master, fargs=[master_pod_ip], tries=20, delay=3)
+        self.assertEqual("off", test_utils.execute_query(new_master_pod_ip, 5432,
+                                                         "SHOW default_transaction_read_only")[0][0])
+        test_utils.execute_query(new_master_pod_ip, 5432, insert_query)
+        test_utils.create_table()
+
+    def assert_db_is_read_only(self, db_host_ip, query):
+        with self.assertRaises(ReadOnlySqlTransaction):
+            test_utils.execute_query(db_host_ip, 5432, query)
+
+    def assert_new_master(self, old_master_pod_ip):
+        new_master_pod_ip = self.assert_lb_backend_state("master", 1)[0][1]
+        self.assertNotEqual(old_master_pod_ip, new_master_pod_ip)
+        return new_master_pod_ip
+
     def assert_table_size(self, db_host_ip, table_name, expected_row_count):
         query = "SELECT count(*) FROM " + table_name
         row_count = test_utils.execute_query(db_host_ip, 5432, query)[0][0]
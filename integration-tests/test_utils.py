@@ -129,6 +129,28 @@ def start_db_pod_stress(pod_name):
     logging.info("Started stress command for pod %s, output:\n %s", pod_name, full_output)
 
 
+def stop_db_pod_postgres(pod_name):
+    stop_command = ['bash', '-c', 'gosu postgres pg_ctl stop -m immediate -D $PGDATA']
+    output = stream.stream(client.CoreV1Api().connect_get_namespaced_pod_exec, pod_name, MAIN_NAMESPACE,
+                           container='postgres', command=stop_command, stderr=True, stdin=False,
+                           stdout=True, tty=False)
+
+    logging.info("Stopped postgres (immediate mode) for pod %s, output:\n %s", pod_name, output)
+
+
+def destroy_db_pod_consul_sessions(db_pod_name):
+    script = ("import requests; "
+              "sessions = requests.get('http://localhost:8500/v1/session/node/%s').json(); "
+              "[requests.put('http://localhost:8500/v1/session/destroy/' + session['ID']).raise_for_status() "
+              "for session in sessions]; "
+              "print([session['ID'] for session in sessions])" % db_pod_name)
+    output = stream.stream(client.CoreV1Api().connect_get_namespaced_pod_exec, db_pod_name, MAIN_NAMESPACE,
+                           container='controller', command=['python3', '-c', script], stderr=True, stdin=False,
+                           stdout=True, tty=False)
+
+    logging.info("Destroyed the Consul sessions of pod %s, output:\n %s", db_pod_name, output)
+
+
 def kill_wal_receiver_continuously(db_pod_name):
     stress_commands = [
         ['bash', '-c', "echo 'while true; do pkill -f walreceiver; done' > kill_wal.sh"],
@@ -0,0 +1,98 @@
+#!/bin/sh -e
+
+config_dir=/tmp/pgbouncer
+master_file=${MASTER_FILE:-/pooler/master}
+master_port=${POOLER_MASTER_PORT:-6543}
+standby_port=${POOLER_STANDBY_PORT:-6544}
+pause_timeout=${POOLER_PAUSE_TIMEOUT:-10}
+
+write_config() {
+	name=$1
+	port=$2
+	db_conn_str=$3
+	cat > $config_dir/$name.ini.tmp <<-END
+		[databases]
+		$POSTGRES_DB = $db_conn_str dbname=$POSTGRES_DB
+
+		[pgbouncer]
+		listen_addr = *
+		listen_port = $port
+		unix_socket_dir = $config_dir
+		pidfile = $config_dir/$name.pid
+		auth_type = md5
+		auth_file = $config_dir/userlist.txt
+		auth_user = $SUPER_USER
+		admin_users = $SUPER_USER
+		pool_mode = ${POOLER_POOL_MODE:-transaction}
+		default_pool_size = ${POOLER_DEFAULT_POOL_SIZE:-20}
+		max_client_conn = ${POOLER_MAX_CLIENT_CONN:-5000}
+		ignore_startup_parameters = extra_float_digits
+	END
+	mv $config_dir/$name.ini.tmp $config_dir/$name.ini
+}
+
+admin() {
+	PGPASSWORD="$PASSWORD_SUPER_USER" timeout $pause_timeout \
+		psql -h 127.0.0.1 -p $master_port -U $SUPER_USER -d pgbouncer -tAc "$1"
+}
+
+pause_master_pool() {
+	if [ -n "$paused" ]; then
+		return
+	fi
+
+	echo "Pausing the master pool (waiting for the running transactions to finish)..."
+	if admin "PAUSE $POSTGRES_DB"; then
+		paused=true
+		return
+	fi
+
+	echo "Could not pause within ${pause_timeout}s, killing the master pool's client and server connections..."
+	admin "KILL $POSTGRES_DB" && paused=true
+}
+
+retarget_master_pool() {
+	master=$(cat $master_file 2>/dev/null || true)
+	pod_name=$(echo $master | cut -s -d ',' -f 1)
+	addr=$(echo $master | cut -s -d ',' -f 2)
+
+	pause_master_pool || return
+	if [ -z "$pod_name" ]; then
+		echo "No master is available, keeping the master pool paused!"
+		return
+	fi
+
+	echo "Retargeting the master pool to pod $pod_name with ip $addr..."
+	write_config master $master_port "host=$addr port=5432"
+	admin "RELOAD" || return
+	admin "RESUME $POSTGRES_DB" || return
+	paused=
+}
+
+mkdir -p $config_dir
+echo "\"$SUPER_USER\" \"$PASSWORD_SUPER_USER\"" > $config_dir/userlist.txt
+write_config master $master_port "host=127.0.0.1 port=${LB_MASTER_PORT:-5432}"
+write_config standby $standby_port "host=127.0.0.1 port=${LB_STANDBY_PORT:-5433}"
+
+pgbouncer $config_dir/master.ini &
+master_pid=$!
+pgbouncer $config_dir/standby.ini &
+standby_pid=$!
+trap "kill $master_pid $standby_pid" TERM INT
+
+paused=
+last_master=
+while kill -0 $master_pid && kill -0 $standby_pid; do
+	current_master=$(cat $master_file 2>/dev/null || true)
+	if [ "$current_master" != "$last_master" ]; then
+		if retarget_master_pool; then
+			last_master=$current_master
+		else
+			echo "Retargeting the master pool failed, retrying..."
+		fi
+	fi
+	sleep 0.2
+done
+
+echo "A pgbouncer process exited!"
+exit 1
@@ -11,6 +11,7 @@ shift
 
 postgres_image_tag=${POSTGRES_IMAGE_TAG:-12.2}
 docker build -t ha-postgres-controller:1.0.0 ha-postgres-controller/
+docker build -t ha-postgres-pooler:1.0.0 pooler/
 docker build --build-arg base_image_tag=$postgres_image_tag -t ha-postgres:$postgres_image_tag ha-postgres/
 
 